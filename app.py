@@ -1,12 +1,17 @@
+import asyncio
+import typing as tp
+
 from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from loguru import logger
 
 from src.database import MongoDbWrapper
-from src.dependencies import authenticate
+from src.dependencies import authenticate, start_employee_cache_invalidation
 from src.io_gateway.app import router as io_gateway_router
 from src.logging_config import CONSOLE_LOGGING_CONFIG, FILE_LOGGING_CONFIG
 from src.printing.app import router as printing_router
+from src.shared.config import config
+from src.storage import StorageManager
 from src.video.app import router as video_router
 
 # apply logging configuration
@@ -27,6 +32,8 @@ app.include_router(io_gateway_router, prefix="/io-gateway", dependencies=[Depend
 app.include_router(printing_router, prefix="/printing", dependencies=[Depends(authenticate)], tags=["Printing"])
 app.include_router(video_router, prefix="/video", tags=["Video"])
 
+background_tasks: tp.Set["asyncio.Task[None]"] = set()
+
 # allow CORS
 app.add_middleware(
     CORSMiddleware,
@@ -39,6 +46,8 @@ app.add_middleware(
 
 @app.on_event("startup")
 @logger.catch(reraise=True)
-def startup_event() -> None:
+async def startup_event() -> None:
     """tasks to do at server startup"""
-    MongoDbWrapper()
+    background_tasks.add(asyncio.create_task(MongoDbWrapper().create_indexes()))
+    start_employee_cache_invalidation()
+    background_tasks.add(asyncio.create_task(StorageManager().run(config.storage.check_interval)))
@@ -1,9 +1,14 @@
+import asyncio
 import typing as tp
+from datetime import datetime
+from time import monotonic
 
 from loguru import logger
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import DESCENDING
+from pymongo.errors import ConnectionFailure
 
-from .models import Employee
+from .models import Employee, PinJob, PublishedFile, RecordEntry
 from .shared.config import config
 from .shared.Singleton import SingletonMeta
 
@@ -25,17 +30,71 @@ class MongoDbWrapper(metaclass=SingletonMeta):
         """connect to database using credentials"""
         logger.info("Connecting to MongoDB")
         mongo_client_url: str = config.mongo_db.mongo_connection_url
-        mongo_client: AsyncIOMotorClient = AsyncIOMotorClient(mongo_client_url)
+        mongo_client: AsyncIOMotorClient = AsyncIOMotorClient(
+            mongo_client_url,
+            maxPoolSize=config.mongo_db.max_pool_size,
+            minPoolSize=config.mongo_db.min_pool_size,
+            serverSelectionTimeoutMS=config.mongo_db.server_selection_timeout_ms,
+            readPreference=config.mongo_db.read_preference,
+        )
 
         db_name: str = _get_database_name(mongo_client_url)
         self._database = mongo_client[db_name]
         self._employee_collection: AsyncIOMotorCollection = self._database["employeeData"]
+        self._pin_job_collection: AsyncIOMotorCollection = self._database["pinJobs"]
+        self._record_collection: AsyncIOMotorCollection = self._database["videoRecords"]
+        self._published_file_collection: AsyncIOMotorCollection = self._database["publishedFiles"]
 
         logger.info("Connected to MongoDB")
 
+    async def create_indexes(self, min_delay: float = 1, max_delay: float = 60) -> None:
+        """make sure the collections are indexed for the queries in use. Safe to call on every startup,
+        retries until MongoDB is reachable, so it is meant to run as a background task"""
+        indexes: tp.List[tp.Tuple[AsyncIOMotorCollection, tp.Union[str, tp.List[tp.Tuple[str, int]]], bool]] = [
+            (self._employee_collection, "rfid_card_id", True),
+            (self._pin_job_collection, "cid", True),
+            (self._pin_job_collection, "status", False),
+            (self._record_collection, "record_id", True),
+            (self._record_collection, "status", False),
+            # matches the sort of the records list, its start_time prefix serves the start time filters too
+            (self._record_collection, [("start_time", DESCENDING), ("record_id", DESCENDING)], False),
+            (self._record_collection, "end_time", False),
+            (self._record_collection, "camera_number", False),
+            (self._record_collection, "updated_at", False),
+            (self._published_file_collection, "path", True),
+        ]
+
+        delay = min_delay
+
+        while indexes:
+            collection_, key, unique = indexes[0]
+
+            try:
+                await collection_.create_index(key, unique=unique)
+            except ConnectionFailure as e:
+                logger.error(f"Cannot reach MongoDB to create indexes, retrying in {delay} s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+                continue
+            except Exception as e:
+                logger.error(f"Failed to create an index on {collection_.name}.{key}: {e}")
+
+            indexes.pop(0)
+            delay = min_delay
+
+        logger.info("MongoDB indexes are in place")
+
     @staticmethod
-    async def _get_element_by_key(collection_: AsyncIOMotorCollection, key: str, value: str) -> tp.Dict[str, tp.Any]:
-        result: tp.Dict[str, tp.Any] = await collection_.find_one({key: value}, {"_id": 0})
+    async def _get_element_by_key(
+        collection_: AsyncIOMotorCollection, key: str, value: str, fields: tp.Optional[tp.Iterable[str]] = None
+    ) -> tp.Dict[str, tp.Any]:
+        projection: tp.Dict[str, int] = {"_id": 0, **{field: 1 for field in fields or ()}}
+        t0 = monotonic()
+        result: tp.Dict[str, tp.Any] = await collection_.find_one({key: value}, projection)
+        duration_ms = (monotonic() - t0) * 1000
+
+        if duration_ms > config.mongo_db.slow_query_ms:
+            logger.warning(f"Slow query on {collection_.name} '{key}:{value}' took {round(duration_ms)} ms")
 
         if not result:
             raise ValueError(f"No results found for query '{key}:{value}'")
@@ -44,10 +103,91 @@ class MongoDbWrapper(metaclass=SingletonMeta):
 
     async def get_concrete_employee(self, card_id: str) -> Employee:
         try:
-            employee_data = await self._get_element_by_key(self._employee_collection, key="rfid_card_id", value=card_id)
+            employee_data = await self._get_element_by_key(
+                self._employee_collection, key="rfid_card_id", value=card_id, fields=Employee.__fields__
+            )
         except ValueError:
             raise ValueError(f"Employee with card id {card_id} not found")
 
         return Employee(
             name=employee_data["name"], position=employee_data["position"], rfid_card_id=employee_data["rfid_card_id"]
         )
+
+    async def watch_employee_changes(self) -> tp.AsyncIterator[tp.Optional[str]]:
+        """
+        yield RFID card ids of the inserted employees and None on any other change (update, replace, delete),
+        as the card id the changed document had before is not part of the change event
+        """
+        pipeline = [{"$match": {"operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+
+        async with self._employee_collection.watch(pipeline) as stream:
+            async for change in stream:
+                if change["operationType"] == "insert":
+                    yield change["fullDocument"].get("rfid_card_id")
+                else:
+                    yield None
+
+    async def upsert_pin_job(self, job: PinJob) -> None:
+        await self._pin_job_collection.update_one({"cid": job.cid}, {"$set": job.dict()}, upsert=True)
+
+    async def get_pin_job(self, cid: str) -> PinJob:
+        try:
+            job_data = await self._get_element_by_key(self._pin_job_collection, key="cid", value=cid)
+        except ValueError:
+            raise ValueError(f"No pin job found for CID {cid}")
+
+        return PinJob(**job_data)
+
+    async def get_unfinished_pin_jobs(self) -> tp.List[PinJob]:
+        cursor = self._pin_job_collection.find({"status": {"$in": ["pending", "running"]}}, {"_id": 0})
+        return [PinJob(**job_data) async for job_data in cursor]
+
+    async def upsert_record(self, record: RecordEntry) -> None:
+        await self._record_collection.update_one({"record_id": record.record_id}, {"$set": record.dict()}, upsert=True)
+
+    async def get_record(self, record_id: str) -> RecordEntry:
+        try:
+            record_data = await self._get_element_by_key(self._record_collection, key="record_id", value=record_id)
+        except ValueError:
+            raise ValueError(f"No recording found for id {record_id}")
+
+        return RecordEntry(**record_data)
+
+    async def get_records_by_status(self, statuses: tp.Iterable[str]) -> tp.List[RecordEntry]:
+        cursor = self._record_collection.find({"status": {"$in": list(statuses)}}, {"_id": 0})
+        return [RecordEntry(**record_data) async for record_data in cursor]
+
+    async def upsert_published_file(self, published_file: PublishedFile) -> None:
+        await self._published_file_collection.update_one(
+            {"path": published_file.path}, {"$set": published_file.dict()}, upsert=True
+        )
+
+    async def get_published_files(self, paths: tp.Iterable[str]) -> tp.Dict[str, PublishedFile]:
+        """get the given absolute paths which have been published, by path"""
+        cursor = self._published_file_collection.find({"path": {"$in": list(paths)}}, {"_id": 0})
+        return {file_data["path"]: PublishedFile(**file_data) async for file_data in cursor}
+
+    async def find_records(
+        self,
+        query: tp.Dict[str, tp.Any],
+        before: tp.Optional[tp.Tuple[datetime, str]] = None,
+        limit: int = 100,
+    ) -> tp.List[RecordEntry]:
+        """get the records matching the query, latest first, starting after the (start_time, record_id) cursor"""
+        if before is not None:
+            start_time, record_id = before
+            query = {
+                **query,
+                "$or": [
+                    {"start_time": {"$lt": start_time}},
+                    {"start_time": start_time, "record_id": {"$lt": record_id}},
+                ],
+            }
+
+        cursor = self._record_collection.find(query, {"_id": 0})
+        cursor = cursor.sort([("start_time", -1), ("record_id", -1)]).limit(limit)
+        return [RecordEntry(**record_data) async for record_data in cursor]
+
+    async def get_last_record_update(self) -> tp.Optional[datetime]:
+        record_data = await self._record_collection.find_one({}, {"_id": 0, "updated_at": 1}, sort=[("updated_at", -1)])
+        return record_data["updated_at"] if record_data else None
@@ -1,19 +1,80 @@
+import asyncio
+import typing as tp
+
 from fastapi import HTTPException, Header, status
+from loguru import logger
+from pymongo.errors import OperationFailure
 
 from .database import MongoDbWrapper
 from .models import Employee
+from .shared.cache import AsyncTTLCache
 from .shared.config import config
 
+employee_cache: AsyncTTLCache[str, Employee] = AsyncTTLCache(
+    ttl=config.mongo_db.employee_cache_ttl,
+    max_size=config.mongo_db.employee_cache_size,
+    negative_ttl=config.mongo_db.employee_cache_negative_ttl,
+    negative=(ValueError,),
+)
+# error code of a change stream opened on a standalone server
+CHANGE_STREAMS_NOT_SUPPORTED: int = 40573
+_invalidation_task: tp.Optional["asyncio.Task[None]"] = None
+
+
+async def _get_employee(card_id: str) -> Employee:
+    return await MongoDbWrapper().get_concrete_employee(card_id)
+
 
 async def authenticate(rfid_card_id: str = Header("1111111111")) -> Employee:
     try:
         if rfid_card_id == "1111111111" and config.api_server.production_environment:
             raise ValueError("Development credentials are not allowed in production environment")
 
-        return await MongoDbWrapper().get_concrete_employee(rfid_card_id)
+        return await employee_cache.get(rfid_card_id, _get_employee)
 
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=f"Authentication failed: {e}",
         )
+
+
+async def invalidate_employee_cache(min_delay: float = 1, max_delay: float = 60) -> None:
+    """
+    drop cached employees as soon as they change in the database. Requires MongoDB change streams support.
+    The change stream is reopened with an exponential backoff if it fails.
+    """
+    delay = min_delay
+
+    while True:
+        try:
+            async for card_id in MongoDbWrapper().watch_employee_changes():
+                if card_id is None:
+                    employee_cache.clear()
+                else:
+                    employee_cache.invalidate(card_id)
+
+                logger.debug(f"Employee cache invalidated for card {card_id or 'all cards'}")
+                delay = min_delay
+
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAMS_NOT_SUPPORTED:
+                logger.warning(f"Cannot watch employee changes, cached employees will only expire by TTL: {e}")
+                return
+
+            logger.warning(f"Employee changes stream failed: {e}. Reopening it in {delay} s.")
+        except Exception as e:
+            logger.warning(f"Employee changes stream failed: {e}. Reopening it in {delay} s.")
+
+        # changes made while the stream was down are missed
+        employee_cache.clear()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def start_employee_cache_invalidation() -> None:
+    """start the employee cache invalidation daemon"""
+    global _invalidation_task
+
+    if _invalidation_task is None:
+        _invalidation_task = asyncio.create_task(invalidate_employee_cache())
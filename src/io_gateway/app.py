@@ -5,28 +5,48 @@ import os
 import typing as tp
 from pathlib import Path
 
-from fastapi import APIRouter, Depends, File, UploadFile, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from loguru import logger
 
 from . import ipfs, pinata
+from .cid import CidBuilder, PublishIndex, compute_file_cid
 from .dependencies import get_file
-from .models import GenericResponse, IpfsPublishResponse
+from .models import (
+    AbsolutePath,
+    BatchPublishRequest,
+    BatchPublishResponse,
+    BatchPublishResult,
+    GenericResponse,
+    IpfsPublishResponse,
+    PinStatusResponse,
+)
+from .pin_queue import PinQueue
+from .streaming import TeeBranch, UploadStream, iter_file, tee
+from ..database import MongoDbWrapper
+from ..models import PublishedFile
 from ..shared.config import config
+from ..storage import get_size
+
+# how many files of a batch are published simultaneously
+BATCH_CONCURRENCY: int = 4
 
 router = APIRouter()
+publish_index = PublishIndex()
 
 
 @router.post("/publish-to-ipfs/by-path", response_model=tp.Union[IpfsPublishResponse, GenericResponse])  # type: ignore
 async def publish_file_to_ipfs_by_path(
     file: Path = Depends(get_file),
+    rehash: bool = False,
 ) -> tp.Union[IpfsPublishResponse, GenericResponse]:
     """
     Publish file to IPFS using local node (if enabled by config) and / or pin to Pinata pinning cloud (if enabled by config).
 
-    File is accepted as an absolute path to the desired file on the host machine
+    File is accepted as an absolute path to the desired file on the host machine. Set rehash to hash the file
+    before uploading it, so content already published under another path is not uploaded again.
     """
     try:
-        cid, uri = await publish_file(file)
+        cid, uri = await publish_file(file, rehash)
         message = f"File {file.name} published"
         logger.info(message)
         return IpfsPublishResponse(status=status.HTTP_200_OK, details=message, ipfs_cid=cid, ipfs_link=uri)
@@ -38,26 +58,21 @@ async def publish_file_to_ipfs_by_path(
 
 
 @router.post("/publish-to-ipfs/upload-file", response_model=tp.Union[IpfsPublishResponse, GenericResponse])  # type: ignore
-async def publish_file_to_ipfs_as_upload(
-    file_data: UploadFile = File(...),
-) -> tp.Union[IpfsPublishResponse, GenericResponse]:
+async def publish_file_to_ipfs_as_upload(request: Request) -> tp.Union[IpfsPublishResponse, GenericResponse]:
     """
     Publish file to IPFS using local node (if enabled by config) and / or pin to Pinata pinning cloud (if enabled by config).
 
-    File is accepted as an UploadFile (multipart form data)
+    File is accepted as an UploadFile (multipart form data) in the `file_data` field.
+    The upload is streamed to IPFS and Pinata as it arrives and is never saved on the disk.
     """
     try:
-        # temporary fix using on disk caching, need to be reworked to work without saving data on the disk
-        cache_dir = "cache"
-        if not os.path.exists(cache_dir):
-            os.mkdir(cache_dir)
-
-        path = f"{cache_dir}/{file_data.filename}"
-        with open(path, "wb") as f:
-            f.write(file_data.file.read())
-
-        cid, uri = await publish_file(Path(path))
-        message = f"File {file_data.filename} published"
+        upload = UploadStream(request, field_name="file_data")
+        filename = await upload.open()
+        cid_builder = CidBuilder()
+        cid, uri = await publish_stream(filename, cid_builder.tap(upload.chunks()))
+        _check_local_cid(filename, cid_builder.cid(), cid)
+        publish_index.add(cid, uri)
+        message = f"File {filename} published"
         logger.info(message)
         return IpfsPublishResponse(status=status.HTTP_200_OK, details=message, ipfs_cid=cid, ipfs_link=uri)
 
@@ -67,15 +82,227 @@ async def publish_file_to_ipfs_as_upload(
         return GenericResponse(status=status.HTTP_500_INTERNAL_SERVER_ERROR, details=message)
 
 
-async def publish_file(file: tp.Union[os.PathLike[tp.AnyStr], tp.IO[bytes]]) -> tp.Tuple[str, str]:
-    if config.ipfs.enable and config.pinata.enable:
-        cid, uri = ipfs.publish_to_ipfs(file)
-        asyncio.create_task(pinata.pin_file(file))
+@router.post("/publish-to-ipfs/batch", response_model=tp.Union[BatchPublishResponse, GenericResponse])  # type: ignore
+async def publish_files_to_ipfs_in_batch(
+    request: BatchPublishRequest,
+) -> tp.Union[BatchPublishResponse, GenericResponse]:
+    """
+    Publish several files to IPFS and / or Pinata at once.
+
+    Files are accepted as a list of absolute paths which are published concurrently and / or as an absolute path
+    to a directory which is published to IPFS as an IPFS directory. Errors are reported for every file separately.
+    """
+    try:
+        results: tp.List[BatchPublishResult] = []
+        dir_cid: tp.Optional[str] = None
+        dir_link: tp.Optional[str] = None
+
+        if request.directory is not None:
+            dir_cid, dir_link, results = await publish_directory(Path(request.directory))
+
+        slots = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+        async def publish_one(path: str) -> BatchPublishResult:
+            async with slots:
+                try:
+                    cid, uri = await publish_file(get_file(AbsolutePath(absolute_path=path)), request.rehash)
+                    return BatchPublishResult(absolute_path=path, ipfs_cid=cid, ipfs_link=uri)
+                except HTTPException as e:
+                    return BatchPublishResult(absolute_path=path, error=e.detail)
+                except Exception as e:
+                    return BatchPublishResult(absolute_path=path, error=str(e))
+
+        results.extend(await asyncio.gather(*(publish_one(path) for path in request.absolute_paths)))
+        failed = sum(result.error is not None for result in results)
+        message = f"Published {len(results) - failed} files, {failed} failed"
+        logger.info(message)
+        return BatchPublishResponse(
+            status=status.HTTP_200_OK, details=message, ipfs_cid=dir_cid, ipfs_link=dir_link, results=results
+        )
+
+    except Exception as e:
+        message = f"An error occurred while publishing files to IPFS: {e}"
+        logger.error(message)
+        return GenericResponse(status=status.HTTP_500_INTERNAL_SERVER_ERROR, details=message)
+
+
+@router.get("/pins/{cid}", response_model=tp.Union[PinStatusResponse, GenericResponse])  # type: ignore
+async def get_pin_status(cid: str) -> tp.Union[PinStatusResponse, GenericResponse]:
+    """Get the status of background pinning of the file with the provided CID to Pinata"""
+    try:
+        job = await MongoDbWrapper().get_pin_job(cid)
+        return PinStatusResponse(
+            status=status.HTTP_200_OK,
+            details=f"Pinning of {cid} is {job.status}",
+            ipfs_cid=cid,
+            pin_status=job.status,
+            attempts=job.attempts,
+            last_error=job.last_error,
+            updated_at=job.updated_at,
+        )
+
+    except ValueError as e:
+        return GenericResponse(status=status.HTTP_404_NOT_FOUND, details=str(e))
+
+
+def _check_local_cid(name: str, local_cid: str, cid: str) -> None:
+    if local_cid != cid:
+        logger.warning(f"Locally computed CID {local_cid} of {name} does not match the published one ({cid})")
+
+
+async def _find_published(path: str, rehash: bool = False) -> tp.Optional[tp.Tuple[str, str]]:
+    """look the file up in the index of already published content by its path and, if asked, by its contents"""
+    cid = publish_index.get_file_cid(path)
+
+    if cid is None and rehash:
+        cid = await asyncio.get_running_loop().run_in_executor(None, compute_file_cid, path)
+        publish_index.add_file(path, cid)
+
+    link = publish_index.get_link(cid) if cid is not None else None
+    return (cid, link) if cid is not None and link is not None else None
+
+
+async def _remember_published(path: str, cid: str) -> None:
+    """record the published file or directory, so that the storage manager knows it may be evicted"""
+    try:
+        published_file = PublishedFile(path=os.path.abspath(path), cid=cid, size=get_size(path))
+        await MongoDbWrapper().upsert_published_file(published_file)
+    except Exception as e:
+        logger.error(f"Failed to record {path} as published: {e}")
+
+
+async def publish_directory(directory: Path) -> tp.Tuple[str, str, tp.List[BatchPublishResult]]:
+    """publish a directory to IPFS as a whole and pin every file inside it to Pinata if enabled by config"""
+    if not directory.is_dir():
+        raise ValueError(f"Directory {directory} doesn't exist")
+
+    if not config.ipfs.enable:
+        raise ValueError("IPFS is disabled in config, cannot publish a directory")
+
+    cid, uri, files_cids = await ipfs.publish_directory(directory)
+    results = []
+
+    for path, file_cid in files_cids.items():
+        if not path.is_file():
+            continue
+
+        file_uri = config.ipfs.gateway_address + file_cid
+        publish_index.add(file_cid, file_uri, str(path))
+        results.append(BatchPublishResult(absolute_path=str(path), ipfs_cid=file_cid, ipfs_link=file_uri))
+
+        if config.pinata.enable:
+            await PinQueue().enqueue(file_cid, path)
+
+    await asyncio.gather(
+        _remember_published(str(directory), cid),
+        *(_remember_published(str(path), file_cid) for path, file_cid in files_cids.items() if path.is_file()),
+    )
+    return cid, uri, results
+
+
+async def publish_file(
+    file: tp.Union[os.PathLike[tp.AnyStr], tp.IO[bytes]], rehash: bool = False
+) -> tp.Tuple[str, str]:
+    """
+    publish a local file or a file object. A file already published under the same path is not uploaded again
+    unless it has changed since. With rehash the file is hashed beforehand to find the same content under any path.
+    An HLS playlist is published along with its segments as an IPFS directory.
+    """
+    path = os.fsdecode(file) if isinstance(file, os.PathLike) else None
+
+    if path is not None and path.endswith(".m3u8"):
+        # an HLS playlist is of no use without its segments, so the whole directory is published
+        cid, uri, _ = await publish_directory(Path(path).parent)
+        return cid, uri
+
+    if path is not None and (published := await _find_published(path, rehash)) is not None:
+        logger.info(f"File {path} has already been published as {published[0]}, skipping upload")
+        return published
+
+    if config.ipfs.enable and path is not None:
+        # the CID is computed on the way to the node, so the file is read only once
+        cid_builder = CidBuilder()
+        cid, uri = await ipfs.publish_stream(os.path.basename(path), cid_builder.tap(iter_file(file)))
+        _check_local_cid(path, cid_builder.cid(), cid)
+
+        if config.pinata.enable:
+            await PinQueue().enqueue(cid, Path(path))
+    elif config.ipfs.enable and config.pinata.enable:
+        # a file object can only be read once, so the same stream is fed to both IPFS and Pinata
+        cid, uri = await publish_stream(str(getattr(file, "name", "file")), iter_file(file))
     elif config.ipfs.enable:
-        cid, uri = ipfs.publish_to_ipfs(file)
+        cid, uri = await ipfs.publish_to_ipfs(file)
     elif config.pinata.enable:
         cid, uri = await pinata.pin_file(file)
     else:
         raise ValueError("Both IPFS and Pinata are disabled in config, cannot get CID")
 
+    publish_index.add(cid, uri, path)
+
+    if path is not None:
+        await _remember_published(path, cid)
+
+    return cid, uri
+
+
+async def _pin_stream_quietly(filename: str, chunks: TeeBranch) -> None:
+    """pin a stream to Pinata alongside IPFS publishing, a failure here must not fail the publish"""
+    try:
+        await pinata.pin_stream(filename, chunks)
+    except Exception as e:
+        logger.error(f"Failed to pin {filename} to Pinata: {e}")
+    finally:
+        await chunks.aclose()
+
+
+async def _publish_branch_to_ipfs(filename: str, chunks: TeeBranch) -> tp.Tuple[str, str]:
+    try:
+        return await ipfs.publish_stream(filename, chunks)
+    finally:
+        await chunks.aclose()
+
+
+async def publish_stream(filename: str, chunks: tp.AsyncIterable[bytes]) -> tp.Tuple[str, str]:
+    if config.ipfs.enable and config.pinata.enable:
+        ipfs_chunks, pinata_chunks = tee(chunks, 2)
+        ipfs_task = asyncio.create_task(_publish_branch_to_ipfs(filename, ipfs_chunks))
+        pinata_task = asyncio.create_task(_pin_stream_quietly(filename, pinata_chunks))
+
+        try:
+            (cid, uri), _ = await asyncio.gather(ipfs_task, pinata_task)
+        except BaseException:
+            # the publish has failed, so the Pinata upload is pointless and must not outlive the request
+            for task in (ipfs_task, pinata_task):
+                task.cancel()
+
+            await asyncio.gather(ipfs_task, pinata_task, return_exceptions=True)
+            raise
+    elif config.ipfs.enable:
+        cid, uri = await ipfs.publish_stream(filename, chunks)
+    elif config.pinata.enable:
+        cid, uri = await pinata.pin_stream(filename, chunks)
+    else:
+        raise ValueError("Both IPFS and Pinata are disabled in config, cannot get CID")
+
     return cid, uri
+
+
+@router.on_event("startup")
+@logger.catch(reraise=True)
+async def startup_event() -> None:
+    """tasks to do at server startup"""
+    ipfs.start_monitoring()
+
+    if config.ipfs.enable and config.pinata.enable:
+        await PinQueue().start()
+
+
+@router.on_event("shutdown")
+@logger.catch(reraise=True)
+async def shutdown_event() -> None:
+    """tasks to do at server shutdown"""
+    if config.ipfs.enable and config.pinata.enable:
+        await PinQueue().stop()
+
+    await ipfs.close()
+    await pinata.close()
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import typing as tp
+from collections import OrderedDict
+
+# parameters of the IPFS node `add` defaults: fixed size chunker, balanced layout, dag-pb leaves, CIDv0
+CHUNK_SIZE: int = 256 * 1024
+MAX_LINKS: int = 174
+_UNIXFS_FILE: int = 2
+_BASE58_ALPHABET: str = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+
+class _Node(tp.NamedTuple):
+    multihash: bytes
+    cumulative_size: int  # size of the serialized node and all of its descendants
+    file_size: int  # amount of file bytes under the node
+
+
+def _varint(value: int) -> bytes:
+    result = bytearray()
+
+    while value > 0x7F:
+        result.append(value & 0x7F | 0x80)
+        value >>= 7
+
+    result.append(value)
+    return bytes(result)
+
+
+def _field(number: int, payload: bytes) -> bytes:
+    """encode a length delimited protobuf field"""
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _commit(data: tp.Optional[bytes], children: tp.Sequence[_Node]) -> _Node:
+    """serialize a UnixFS file node as dag-pb and hash it"""
+    file_size = len(data or b"") + sum(child.file_size for child in children)
+    unixfs = _varint(1 << 3) + _varint(_UNIXFS_FILE)
+
+    if data is not None:
+        unixfs += _field(2, data)
+
+    unixfs += _varint(3 << 3) + _varint(file_size)
+    unixfs += b"".join(_varint(4 << 3) + _varint(child.file_size) for child in children)
+
+    # dag-pb canonical form puts links before data
+    links = (
+        _field(1, child.multihash) + _field(2, b"") + _varint(3 << 3) + _varint(child.cumulative_size)
+        for child in children
+    )
+    serialized = b"".join(_field(2, link) for link in links) + _field(1, unixfs)
+    multihash = b"\x12\x20" + hashlib.sha256(serialized).digest()
+    return _Node(multihash, len(serialized) + sum(child.cumulative_size for child in children), file_size)
+
+
+def _base58(data: bytes) -> str:
+    number = int.from_bytes(data, "big")
+    result = ""
+
+    while number:
+        number, remainder = divmod(number, 58)
+        result = _BASE58_ALPHABET[remainder] + result
+
+    return "1" * (len(data) - len(data.lstrip(b"\0"))) + result
+
+
+class CidBuilder:
+    """Compute the CID an IPFS node would assign to a file, fed with the file contents chunk by chunk"""
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._leaves: tp.List[_Node] = []
+
+    def update(self, data: bytes) -> None:
+        self._buffer += data
+
+        while len(self._buffer) >= CHUNK_SIZE:
+            self._leaves.append(_commit(bytes(self._buffer[:CHUNK_SIZE]), ()))
+            del self._buffer[:CHUNK_SIZE]
+
+    @staticmethod
+    def _layout(leaf_nodes: tp.List[_Node]) -> _Node:
+        """build the balanced DAG on top of the leaves the same way the node does"""
+        leaves = iter(leaf_nodes)
+
+        if not leaf_nodes:
+            return _commit(None, ())
+
+        def fill(depth: int, children: tp.List[_Node]) -> _Node:
+            while len(children) < MAX_LINKS and (child := next_child(depth)) is not None:
+                children.append(child)
+
+            return _commit(None, children)
+
+        def next_child(depth: int) -> tp.Optional[_Node]:
+            if depth == 1:
+                return next(leaves, None)
+
+            if (first := next_child(depth - 1)) is None:
+                return None
+
+            return fill(depth - 1, [first])
+
+        root = next(leaves)
+        depth = 1
+
+        while (child := next_child(depth)) is not None:
+            root = fill(depth, [root, child])
+            depth += 1
+
+        return root
+
+    def cid(self) -> str:
+        """get the CIDv0 of the data fed so far"""
+        leaves = self._leaves + [_commit(bytes(self._buffer), ())] if self._buffer else self._leaves
+        return _base58(self._layout(leaves).multihash)
+
+    async def tap(self, chunks: tp.AsyncIterable[bytes]) -> tp.AsyncIterator[bytes]:
+        """pass a byte stream through, hashing it on the way"""
+        async for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+
+def compute_file_cid(path: tp.Union[str, os.PathLike[str]]) -> str:
+    """compute the CID of a local file. Blocking, meant to be run in an executor"""
+    builder = CidBuilder()
+
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            builder.update(chunk)
+
+    return builder.cid()
+
+
+class PublishIndex:
+    """
+    An LRU index of the already published content.
+
+    Maps CIDs to their IPFS links and local files to their CIDs. File entries are keyed by path
+    and are only valid as long as the file modification time and size stay the same.
+    """
+
+    def __init__(self, max_entries: int = 10_000) -> None:
+        self._max_entries = max_entries
+        self._links: tp.OrderedDict[str, str] = OrderedDict()
+        self._files: tp.OrderedDict[str, tp.Tuple[int, int, str]] = OrderedDict()
+
+    @staticmethod
+    def _get_file_key(path: str) -> tp.Tuple[int, int]:
+        stat = os.stat(path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _remember(self, index: tp.OrderedDict[str, tp.Any], key: str, value: tp.Any) -> None:
+        index[key] = value
+        index.move_to_end(key)
+
+        if len(index) > self._max_entries:
+            index.popitem(last=False)
+
+    def get_link(self, cid: str) -> tp.Optional[str]:
+        """get the link of a CID if it has already been published"""
+        link = self._links.get(cid)
+
+        if link is not None:
+            self._links.move_to_end(cid)
+
+        return link
+
+    def get_file_cid(self, path: str) -> tp.Optional[str]:
+        """get the CID of a file if it has been indexed and has not changed since"""
+        entry = self._files.get(path)
+
+        if entry is None:
+            return None
+
+        mtime, size, cid = entry
+
+        if (mtime, size) != self._get_file_key(path):
+            del self._files[path]
+            return None
+
+        self._files.move_to_end(path)
+        return cid
+
+    def add(self, cid: str, link: str, path: tp.Optional[str] = None) -> None:
+        """remember published content and, optionally, the local file it came from"""
+        self._remember(self._links, cid, link)
+
+        if path is not None:
+            self._remember(self._files, path, (*self._get_file_key(path), cid))
+
+    def add_file(self, path: str, cid: str) -> None:
+        """remember the CID of a local file regardless of it being published"""
+        self._remember(self._files, path, (*self._get_file_key(path), cid))
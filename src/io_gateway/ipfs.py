@@ -1,55 +1,194 @@
 from __future__ import annotations
 
+import asyncio
+import json
 import os
 import typing as tp
-from time import sleep
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import quote
+from uuid import uuid4
 
-import ipfshttpclient
+import httpx
 from loguru import logger
 
+from .streaming import iter_file, multipart_entries
 from ..shared.config import config
 
 IS_DOCKERIZED: bool = bool(os.environ.get("IS_DOCKERIZED", False))
 logger.info(f"App {'is' if IS_DOCKERIZED else 'is not'} running in a containerized environment")
 
 
-@logger.catch(reraise=True)
-def _get_ipfs_client() -> tp.Optional[ipfshttpclient.Client]:
+_http_client: tp.Optional[httpx.AsyncClient] = None
+_upload_slots: tp.Optional[asyncio.Semaphore] = None
 
-    if not config.ipfs.enable:
-        logger.warning("IPFS capabilities are disabled in config-file")
-        return None
 
-    retry_delay = 5
-    for i in range(5):
+def _get_http_client() -> httpx.AsyncClient:
+    """get the app-wide pooled client for the IPFS node HTTP API"""
+    global _http_client
+
+    if _http_client is None:
+        limits = httpx.Limits(
+            max_connections=config.ipfs.max_concurrent_uploads * 2,
+            max_keepalive_connections=config.ipfs.max_concurrent_uploads,
+        )
+        timeout = httpx.Timeout(None, connect=5.0)
+        _http_client = httpx.AsyncClient(base_url=config.ipfs.api_address, limits=limits, timeout=timeout)
+
+    return _http_client
+
+
+def _get_upload_slots() -> asyncio.Semaphore:
+    """get the semaphore limiting the amount of simultaneous uploads to the node"""
+    global _upload_slots
+
+    if _upload_slots is None:
+        _upload_slots = asyncio.Semaphore(config.ipfs.max_concurrent_uploads)
+
+    return _upload_slots
+
+
+class NodeHealth:
+    """cached state of the IPFS node connection, kept up to date by the `monitor_node` daemon"""
+
+    is_up: tp.Optional[bool] = None  # None until the first check is done
+    last_checked: tp.Optional[datetime] = None
+    last_error: tp.Optional[str] = None
+    recheck: tp.Optional[asyncio.Event] = None
+
+
+_monitor_task: tp.Optional[asyncio.Task[None]] = None
+
+
+def _mark_node_down(error: Exception) -> None:
+    """remember the node is unreachable and wake up the monitor to start reconnecting"""
+    NodeHealth.is_up = False
+    NodeHealth.last_error = str(error)
+
+    if NodeHealth.recheck is not None:
+        NodeHealth.recheck.set()
+
+
+async def _check_node() -> None:
+    """ping the node using its HTTP API"""
+    response = await _get_http_client().post("/api/v0/id", timeout=5.0)
+    response.raise_for_status()
+
+
+async def monitor_node(interval: float = 30, min_delay: float = 1, max_delay: float = 60) -> None:
+    """Keep track of the IPFS node availability. Checked every interval seconds while the node is up,
+    reconnection attempts are made with an exponential backoff while it is down."""
+    NodeHealth.recheck = asyncio.Event()
+    delay = min_delay
+
+    while True:
         try:
-            client = ipfshttpclient.connect()
-            logger.info("Successfully connected to the IPFS node")
-            return client
+            await _check_node()
+
+            if not NodeHealth.is_up:
+                logger.info("Successfully connected to the IPFS node")
+
+            NodeHealth.is_up, NodeHealth.last_error = True, None
+            delay, wait_for = min_delay, interval
 
         except Exception as e:
-            logger.error(f"An error occurred while getting IPFS client: {e}")
-            logger.warning(f"Attempt {i + 1} failed. Retrying in {retry_delay} s.")
-            sleep(retry_delay)
+            if NodeHealth.is_up is not False:
+                logger.error(f"IPFS node is unreachable: {e}")
 
-    logger.warning("Retry attempts count exceeded. Connection to an IPFS node could not be established.")
-    return None
+            NodeHealth.is_up, NodeHealth.last_error = False, str(e)
+            logger.warning(f"Retrying connection to the IPFS node in {delay} s.")
+            delay, wait_for = min(delay * 2, max_delay), delay
 
+        NodeHealth.last_checked = datetime.now()
+        NodeHealth.recheck.clear()
 
-IPFS_CLIENT: tp.Optional[ipfshttpclient.Client] = _get_ipfs_client()
+        try:
+            await asyncio.wait_for(NodeHealth.recheck.wait(), timeout=wait_for)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_monitoring() -> None:
+    """start the node monitoring daemon if IPFS is enabled"""
+    global _monitor_task
+
+    if not config.ipfs.enable:
+        logger.warning("IPFS capabilities are disabled in config-file")
+        return
+
+    if _monitor_task is None:
+        _monitor_task = asyncio.create_task(monitor_node())
+
+
+async def close() -> None:
+    """stop the node monitoring daemon and close the pooled HTTP client"""
+    global _http_client, _monitor_task
+
+    if _monitor_task is not None:
+        _monitor_task.cancel()
+        _monitor_task = None
+
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
 
 
 @logger.catch(reraise=True)
-def publish_to_ipfs(file: tp.Union[os.PathLike[tp.AnyStr], tp.IO[bytes]]) -> tp.Tuple[str, str]:
+async def publish_to_ipfs(file: tp.Union[os.PathLike[tp.AnyStr], tp.IO[bytes]]) -> tp.Tuple[str, str]:
     """publish file on IPFS"""
     logger.info("Publishing file to IPFS")
+    filename = os.path.basename(file) if isinstance(file, os.PathLike) else getattr(file, "name", "file")
+    return await publish_stream(str(filename), iter_file(file))
+
 
-    client = IPFS_CLIENT or _get_ipfs_client()
-    if client is None:
-        raise ConnectionError("Connection to IPFS node failed, cannot publish file")
+async def _add(
+    name: str, entries: tp.List[tp.Tuple[str, tp.Optional[tp.AsyncIterable[bytes]]]]
+) -> tp.List[tp.Dict[str, str]]:
+    """add files to the node, one result is returned for every entry"""
+    if NodeHealth.is_up is False:
+        raise ConnectionError(f"IPFS node is unavailable, cannot publish file: {NodeHealth.last_error}")
 
-    result = client.add(file)
-    ipfs_hash: str = result["Hash"]
+    boundary = uuid4().hex
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    body = multipart_entries(boundary, "file", [(quote(filename, safe=""), chunks) for filename, chunks in entries])
+
+    async with _get_upload_slots():
+        logger.info(f"Streaming {name} to IPFS")
+
+        try:
+            response = await _get_http_client().post("/api/v0/add", content=body, headers=headers)
+        except httpx.TransportError as e:
+            _mark_node_down(e)
+            raise ConnectionError(f"Connection to IPFS node failed, cannot publish file: {e}") from e
+
+    response.raise_for_status()
+    return [json.loads(line) for line in response.text.splitlines() if line]
+
+
+@logger.catch(reraise=True)
+async def publish_stream(filename: str, chunks: tp.AsyncIterable[bytes]) -> tp.Tuple[str, str]:
+    """publish a byte stream on IPFS without buffering it"""
+    result = await _add(f"file {filename}", [(filename, chunks)])
+    ipfs_hash: str = result[-1]["Hash"]
     ipfs_link: str = config.ipfs.gateway_address + ipfs_hash
     logger.info(f"File published to IPFS, hash: {ipfs_hash}")
     return ipfs_hash, ipfs_link
+
+
+@logger.catch(reraise=True)
+async def publish_directory(directory: Path) -> tp.Tuple[str, str, tp.Dict[Path, str]]:
+    """publish a local directory on IPFS as an IPFS directory, get its CID, link and CIDs of the files inside"""
+    entries: tp.List[tp.Tuple[str, tp.Optional[tp.AsyncIterable[bytes]]]] = [(directory.name, None)]
+
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        relative_root = Path(root).relative_to(directory.parent)
+        entries.extend((str(relative_root / dir_), None) for dir_ in dirs)
+        entries.extend((str(relative_root / file), iter_file(Path(root) / file)) for file in sorted(files))
+
+    results = {Path(result["Name"]): result["Hash"] for result in await _add(f"directory {directory}", entries)}
+    ipfs_hash = results.pop(Path(directory.name))
+    ipfs_link: str = config.ipfs.gateway_address + ipfs_hash
+    logger.info(f"Directory published to IPFS, hash: {ipfs_hash}")
+    files_cids = {directory.parent / name: cid for name, cid in results.items()}
+    return ipfs_hash, ipfs_link, files_cids
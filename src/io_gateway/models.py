@@ -1,3 +1,6 @@
+import typing as tp
+from datetime import datetime
+
 from pydantic import BaseModel
 
 
@@ -13,3 +16,30 @@ class IpfsPublishResponse(GenericResponse):
 
 class AbsolutePath(BaseModel):
     absolute_path: str
+
+
+class BatchPublishRequest(BaseModel):
+    absolute_paths: tp.List[str] = []
+    directory: tp.Optional[str] = None  # absolute path to a directory to publish as an IPFS directory
+    rehash: bool = False  # hash the files before uploading to skip content already published under other paths
+
+
+class BatchPublishResult(BaseModel):
+    absolute_path: str
+    ipfs_cid: tp.Optional[str] = None
+    ipfs_link: tp.Optional[str] = None
+    error: tp.Optional[str] = None
+
+
+class BatchPublishResponse(GenericResponse):
+    ipfs_cid: tp.Optional[str] = None  # the directory CID if a directory was published
+    ipfs_link: tp.Optional[str] = None
+    results: tp.List[BatchPublishResult]
+
+
+class PinStatusResponse(GenericResponse):
+    ipfs_cid: str
+    pin_status: str
+    attempts: int
+    last_error: tp.Optional[str]
+    updated_at: datetime
@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import asyncio
+import typing as tp
+from datetime import datetime
+from pathlib import Path
+
+from loguru import logger
+
+from . import pinata
+from ..database import MongoDbWrapper
+from ..models import PinJob
+from ..shared.Singleton import SingletonMeta
+from ..shared.config import config
+
+# failed pins are retried this many times with an exponential backoff, capped at MAX_RETRY_DELAY seconds
+MAX_ATTEMPTS: int = 8
+RETRY_DELAY: float = 10.0
+MAX_RETRY_DELAY: float = 3600.0
+WAIT_POLL_INTERVAL: float = 5.0
+
+
+class PinQueue(metaclass=SingletonMeta):
+    """
+    A persistent queue of files to be pinned to Pinata in the background.
+
+    Jobs are stored in MongoDB before being scheduled, so pins interrupted by a restart are resumed
+    at the next startup. A fixed pool of workers handles the jobs, failed ones are retried with a backoff.
+    """
+
+    def __init__(self) -> None:
+        self._database = MongoDbWrapper()
+        self._queue: asyncio.Queue[str] = asyncio.Queue()
+        self._workers: tp.List[asyncio.Task[None]] = []
+        self._resume_task: tp.Optional[asyncio.Task[None]] = None
+        self._retries: tp.Set[asyncio.TimerHandle] = set()
+
+    async def _resume(self, min_delay: float = 1, max_delay: float = 60) -> None:
+        """queue the jobs left unfinished by a previous run, retrying with a backoff while the database is down"""
+        delay = min_delay
+
+        while True:
+            try:
+                jobs = await self._database.get_unfinished_pin_jobs()
+                break
+            except Exception as e:
+                logger.error(f"Failed to get the unfinished pin jobs: {e}. Retrying in {delay} s.")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+        for job in jobs:
+            logger.info(f"Resuming pinning of {job.cid} ({job.path})")
+            self._queue.put_nowait(job.cid)
+
+    async def start(self) -> None:
+        """start the workers and resume the unfinished jobs in the background"""
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(config.pinata.workers)]
+        self._resume_task = asyncio.create_task(self._resume())
+        logger.info(f"Started {len(self._workers)} Pinata pinning workers")
+
+    async def stop(self) -> None:
+        """stop the workers, unfinished jobs stay in the database"""
+        for handle in self._retries:
+            handle.cancel()
+
+        tasks = [*self._workers, self._resume_task] if self._resume_task is not None else self._workers
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers, self._resume_task = [], None
+
+    async def enqueue(self, cid: str, path: Path) -> PinJob:
+        """schedule pinning of the file with the provided IPFS CID"""
+        try:
+            job = await self._database.get_pin_job(cid)
+
+            if job.status != "failed":
+                logger.debug(f"Pinning of {cid} is already {job.status}")
+                return job
+        except ValueError:
+            pass
+
+        job = PinJob(cid=cid, path=str(path))
+        await self._database.upsert_pin_job(job)
+        self._queue.put_nowait(cid)
+        logger.info(f"Scheduled pinning of {cid} to Pinata")
+        return job
+
+    async def wait(self, cid: str) -> PinJob:
+        """wait for the pinning of the CID to be done or to fail for good"""
+        while True:
+            job = await self._database.get_pin_job(cid)
+
+            if job.status in ("done", "failed"):
+                return job
+
+            await asyncio.sleep(WAIT_POLL_INTERVAL)
+
+    def _retry_later(self, cid: str, delay: float) -> None:
+        def retry() -> None:
+            self._retries.discard(handle)
+            self._queue.put_nowait(cid)
+
+        handle = asyncio.get_running_loop().call_later(delay, retry)
+        self._retries.add(handle)
+
+    async def _handle(self, job: PinJob) -> None:
+        job.status, job.attempts, job.updated_at = "running", job.attempts + 1, datetime.now()
+        await self._database.upsert_pin_job(job)
+
+        try:
+            job.pinata_cid, _ = await pinata.pin_file(Path(job.path))
+            job.status, job.last_error = "done", None
+            logger.info(f"Pinned {job.cid} to Pinata")
+
+        except Exception as e:
+            job.last_error = str(e)
+
+            if job.attempts >= MAX_ATTEMPTS:
+                job.status = "failed"
+                logger.error(f"Pinning {job.cid} failed {job.attempts} times, giving up: {e}")
+            else:
+                job.status = "pending"
+                delay = min(RETRY_DELAY * 2 ** (job.attempts - 1), MAX_RETRY_DELAY)
+                logger.warning(f"Pinning {job.cid} failed (attempt {job.attempts}). Retrying in {delay} s. {e}")
+                self._retry_later(job.cid, delay)
+
+        job.updated_at = datetime.now()
+        await self._database.upsert_pin_job(job)
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            cid = await self._queue.get()
+
+            try:
+                job = await self._database.get_pin_job(cid)
+
+                if job.status in ("pending", "running"):
+                    await self._handle(job)
+
+            except Exception as e:
+                logger.error(f"Pinning worker {number} failed to handle {cid}: {e}")
+
+            finally:
+                self._queue.task_done()
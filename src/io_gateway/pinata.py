@@ -1,12 +1,15 @@
 from __future__ import annotations
 
+import asyncio
 import os
 import typing as tp
 from time import time
+from uuid import uuid4
 
 import httpx
 from loguru import logger
 
+from .streaming import iter_file, multipart_body
 from ..shared.config import config
 
 PINATA_ENDPOINT: str = "https://api.pinata.cloud"
@@ -16,17 +19,63 @@ AUTH_HEADERS = {
     "pinata_api_key": PINATA_API,
     "pinata_secret_api_key": PINATA_SECRET_API,
 }
+# rate limited requests are retried this many times with an exponential backoff starting at RETRY_DELAY seconds
+MAX_ATTEMPTS: int = 5
+RETRY_DELAY: float = 1.0
 
+_http_client: tp.Optional[httpx.AsyncClient] = None
 
-@logger.catch(reraise=True)
-async def pin_file(file: tp.Union[os.PathLike[tp.AnyStr], tp.IO[bytes]]) -> tp.Tuple[str, str]:
-    logger.info("Pushing file to Pinata")
+
+def _get_http_client() -> httpx.AsyncClient:
+    """get the app-wide pooled HTTP/2 client for the Pinata API"""
+    global _http_client
+
+    if _http_client is None:
+        timeout = httpx.Timeout(600.0, connect=10.0)
+        _http_client = httpx.AsyncClient(base_url=PINATA_ENDPOINT, headers=AUTH_HEADERS, timeout=timeout, http2=True)
+
+    return _http_client
+
+
+async def close() -> None:
+    """close the pooled HTTP client"""
+    global _http_client
+
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def _get_retry_delay(response: httpx.Response, attempt: int) -> float:
+    """respect the Retry-After header if Pinata provides one, back off exponentially otherwise"""
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return float(RETRY_DELAY * 2**attempt)
+
+
+async def _pin(
+    filename: tp.Optional[str], get_body: tp.Callable[[], tp.AsyncIterable[bytes]], replayable: bool
+) -> tp.Tuple[str, str]:
+    """post a streamed multipart body to Pinata, retrying rate limited requests if the body can be replayed"""
+    logger.info(f"Pushing file {filename or ''} to Pinata")
     t0 = time()
+    attempts = MAX_ATTEMPTS if replayable else 1
 
-    files = {"file": open(file, "rb") if isinstance(file, os.PathLike) else file}
-    async with httpx.AsyncClient(base_url=PINATA_ENDPOINT, timeout=600.0) as client:
-        response = await client.post("/pinning/pinFileToIPFS", files=files, headers=AUTH_HEADERS)
+    for attempt in range(attempts):
+        boundary = uuid4().hex
+        headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+        body = multipart_body(boundary, "file", filename or uuid4().hex, get_body())
+        response = await _get_http_client().post("/pinning/pinFileToIPFS", content=body, headers=headers)
 
+        if response.status_code != httpx.codes.TOO_MANY_REQUESTS or attempt == attempts - 1:
+            break
+
+        delay = _get_retry_delay(response, attempt)
+        logger.warning(f"Pinata rate limit hit. Attempt {attempt + 1} failed. Retrying in {delay} s.")
+        await asyncio.sleep(delay)
+
+    response.raise_for_status()
     data = response.json()
     ipfs_hash: str = data["IpfsHash"]
     ipfs_link: str = config.ipfs.gateway_address + ipfs_hash
@@ -34,3 +83,25 @@ async def pin_file(file: tp.Union[os.PathLike[tp.AnyStr], tp.IO[bytes]]) -> tp.T
     logger.debug(f"Push took {round(time() - t0, 3)} s.")
     logger.debug(data)
     return ipfs_hash, ipfs_link
+
+
+@logger.catch(reraise=True)
+async def pin_file(file: tp.Union[os.PathLike[tp.AnyStr], tp.IO[bytes]]) -> tp.Tuple[str, str]:
+    """pin a local file or a file object to Pinata"""
+    if isinstance(file, os.PathLike):
+        return await _pin(str(os.path.basename(file)), lambda: iter_file(file), replayable=True)
+
+    start = file.tell() if file.seekable() else None
+
+    def get_body() -> tp.AsyncIterable[bytes]:
+        if start is not None:
+            file.seek(start)
+        return iter_file(file)
+
+    return await _pin(getattr(file, "name", None), get_body, replayable=start is not None)
+
+
+@logger.catch(reraise=True)
+async def pin_stream(filename: str, chunks: tp.AsyncIterable[bytes]) -> tp.Tuple[str, str]:
+    """pin a byte stream to Pinata without buffering it. Such a body cannot be replayed, so it is never retried"""
+    return await _pin(filename, lambda: chunks, replayable=False)
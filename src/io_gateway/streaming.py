@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import typing as tp
+from collections import deque
+from uuid import uuid4
+
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+
+# upper bound for the amount of chunks buffered between the producer and the slowest consumer
+QUEUE_DEPTH: int = 8
+# size of the chunks local files are read in
+CHUNK_SIZE: int = 256 * 1024
+
+_PART_BEGIN, _HEADER_FIELD, _HEADER_VALUE, _HEADER_END, _HEADERS_FINISHED, _PART_DATA, _PART_END = range(7)
+
+
+class UploadStream:
+    """
+    Incrementally parse a multipart/form-data request body and expose one of its file fields as a byte stream.
+
+    The body is never buffered as a whole: every network chunk is fed to the parser and the resulting
+    file data is yielded right away, so memory consumption does not depend on the size of the upload.
+    """
+
+    def __init__(self, request: Request, field_name: str) -> None:
+        content_type, params = parse_options_header(request.headers.get("Content-Type", ""))
+        boundary: tp.Optional[bytes] = params.get(b"boundary")
+
+        if content_type != b"multipart/form-data" or not boundary:
+            raise ValueError("Expected a multipart/form-data request body")
+
+        self._field_name = field_name
+        self._body: tp.AsyncIterator[bytes] = request.stream()
+        self._events: tp.Deque[tp.Tuple[int, bytes]] = deque()
+        self._parser = MultipartParser(boundary, self._get_callbacks())
+        self._header_field = b""
+        self._header_value = b""
+        self._headers: tp.Dict[bytes, bytes] = {}
+        self._exhausted = False
+        self.filename: tp.Optional[str] = None
+
+    def _get_callbacks(self) -> tp.Dict[str, tp.Callable[..., None]]:
+        def on_data(event: int) -> tp.Callable[[bytes, int, int], None]:
+            return lambda data, start, end: self._events.append((event, data[start:end]))
+
+        def on_marker(event: int) -> tp.Callable[[], None]:
+            return lambda: self._events.append((event, b""))
+
+        return {
+            "on_part_begin": on_marker(_PART_BEGIN),
+            "on_part_data": on_data(_PART_DATA),
+            "on_part_end": on_marker(_PART_END),
+            "on_header_field": on_data(_HEADER_FIELD),
+            "on_header_value": on_data(_HEADER_VALUE),
+            "on_header_end": on_marker(_HEADER_END),
+            "on_headers_finished": on_marker(_HEADERS_FINISHED),
+        }
+
+    async def _next_event(self) -> tp.Optional[tp.Tuple[int, bytes]]:
+        """get the next parser event, reading more of the request body if needed"""
+        while not self._events:
+            if self._exhausted:
+                return None
+
+            try:
+                chunk = await self._body.__anext__()
+            except StopAsyncIteration:
+                self._exhausted = True
+                self._parser.finalize()
+                continue
+
+            if chunk:
+                self._parser.write(chunk)
+
+        return self._events.popleft()
+
+    async def open(self) -> str:
+        """consume the body up to the beginning of the file field data and return the uploaded file name"""
+        while (event := await self._next_event()) is not None:
+            event_type, data = event
+
+            if event_type == _PART_BEGIN:
+                self._headers = {}
+            elif event_type == _HEADER_FIELD:
+                self._header_field += data
+            elif event_type == _HEADER_VALUE:
+                self._header_value += data
+            elif event_type == _HEADER_END:
+                self._headers[self._header_field.lower()] = self._header_value
+                self._header_field, self._header_value = b"", b""
+            elif event_type == _HEADERS_FINISHED:
+                _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+
+                if options.get(b"name", b"").decode() == self._field_name and b"filename" in options:
+                    self.filename = options[b"filename"].decode() or uuid4().hex
+                    return self.filename
+
+        raise ValueError(f"No file was provided in the '{self._field_name}' form field")
+
+    async def chunks(self) -> tp.AsyncIterator[bytes]:
+        """yield file field data as it arrives"""
+        if self.filename is None:
+            await self.open()
+
+        while (event := await self._next_event()) is not None:
+            event_type, data = event
+
+            if event_type == _PART_END:
+                break
+
+            if event_type == _PART_DATA and data:
+                yield data
+
+        # drain whatever is left of the body so the connection can be reused
+        while await self._next_event() is not None:
+            pass
+
+
+async def iter_file(file: tp.Union[os.PathLike[tp.AnyStr], tp.IO[bytes]]) -> tp.AsyncIterator[bytes]:
+    """read a local file in chunks without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    f: tp.IO[bytes] = open(file, "rb") if isinstance(file, os.PathLike) else file
+
+    try:
+        while chunk := await loop.run_in_executor(None, f.read, CHUNK_SIZE):
+            yield chunk
+    finally:
+        if f is not file:
+            f.close()
+
+
+class _Tee:
+    """fan a single async byte stream out to several consumers with bounded buffering"""
+
+    _DONE = object()
+
+    def __init__(self, source: tp.AsyncIterable[bytes], branches: int, depth: int) -> None:
+        self._source = source
+        self._queues: tp.List[asyncio.Queue[tp.Any]] = [asyncio.Queue(maxsize=depth) for _ in range(branches)]
+        self._detached: tp.Set[int] = set()
+        self._pump_task: tp.Optional[asyncio.Task[None]] = None
+
+    async def _pump(self) -> None:
+        try:
+            async for chunk in self._source:
+                for i, queue in enumerate(self._queues):
+                    if i not in self._detached:
+                        await queue.put(chunk)
+
+                if len(self._detached) == len(self._queues):
+                    return
+
+            message: tp.Any = self._DONE
+        except Exception as e:
+            message = e
+
+        for i, queue in enumerate(self._queues):
+            if i not in self._detached:
+                await queue.put(message)
+
+    async def get(self, index: int) -> bytes:
+        if self._pump_task is None:
+            self._pump_task = asyncio.create_task(self._pump())
+
+        item = await self._queues[index].get()
+
+        if item is self._DONE:
+            self.detach(index)
+            raise StopAsyncIteration
+
+        if isinstance(item, Exception):
+            self.detach(index)
+            raise item
+
+        chunk: bytes = item
+        return chunk
+
+    def detach(self, index: int) -> None:
+        """stop feeding a consumer which gave up so it does not block the others"""
+        self._detached.add(index)
+        queue = self._queues[index]
+
+        while not queue.empty():
+            queue.get_nowait()
+
+
+class TeeBranch:
+    """one of the streams produced by `tee`. Must be closed by a consumer which stops reading early"""
+
+    def __init__(self, tee_: _Tee, index: int) -> None:
+        self._tee = tee_
+        self._index = index
+
+    def __aiter__(self) -> TeeBranch:
+        return self
+
+    async def __anext__(self) -> bytes:
+        return await self._tee.get(self._index)
+
+    async def aclose(self) -> None:
+        self._tee.detach(self._index)
+
+
+def tee(source: tp.AsyncIterable[bytes], branches: int = 2, depth: int = QUEUE_DEPTH) -> tp.List[TeeBranch]:
+    """split an async byte stream into several independent streams consumed concurrently"""
+    tee_ = _Tee(source, branches, depth)
+    return [TeeBranch(tee_, i) for i in range(branches)]
+
+
+async def multipart_entries(
+    boundary: str, field_name: str, entries: tp.Iterable[tp.Tuple[str, tp.Optional[tp.AsyncIterable[bytes]]]]
+) -> tp.AsyncIterator[bytes]:
+    """encode several files of a multipart/form-data body, entries without a stream are directories"""
+    for filename, chunks in entries:
+        content_type = "application/x-directory" if chunks is None else "application/octet-stream"
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field_name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+
+        if chunks is not None:
+            async for chunk in chunks:
+                yield chunk
+
+        yield b"\r\n"
+
+    yield f"--{boundary}--\r\n".encode()
+
+
+def multipart_body(
+    boundary: str, field_name: str, filename: str, chunks: tp.AsyncIterable[bytes]
+) -> tp.AsyncIterator[bytes]:
+    """encode a byte stream as a single file field of a multipart/form-data body"""
+    return multipart_entries(boundary, field_name, [(filename.replace('"', "%22"), chunks)])
@@ -1,7 +1,64 @@
-from pydantic import BaseModel
+import typing as tp
+from datetime import datetime
+
+from pydantic import BaseModel, Field
 
 
 class Employee(BaseModel):
     rfid_card_id: str
     name: str
     position: str
+
+
+class PinJob(BaseModel):
+    """a background job pinning a file already published to IPFS to Pinata"""
+
+    cid: str
+    path: str
+    status: tp.Literal["pending", "running", "done", "failed"] = "pending"
+    attempts: int = 0
+    last_error: tp.Optional[str] = None
+    pinata_cid: tp.Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.now)
+    updated_at: datetime = Field(default_factory=datetime.now)
+
+
+class PublishedFile(BaseModel):
+    """a local file or directory published to IPFS and / or Pinata, which is safe to remove from the disk"""
+
+    path: str  # absolute
+    cid: str
+    size: int  # the size it was published at, a file which has changed since is not the published one
+    published_at: datetime = Field(default_factory=datetime.now)
+
+
+RecordStatus = tp.Literal[
+    "recording",
+    # post-processing stages
+    "queued",
+    "joining",
+    "remuxing",
+    "transcoding",
+    "thumbnailing",
+    "publishing",
+    # final ones
+    "finished",
+    "failed",
+    "interrupted",
+]
+FINAL_RECORD_STATUSES: tp.Tuple[RecordStatus, ...] = ("finished", "failed", "interrupted")
+
+
+class RecordEntry(BaseModel):
+    """a persisted video recording, only the ongoing ones are kept in memory"""
+
+    record_id: str
+    camera_number: tp.Optional[int] = None
+    filename: tp.Optional[str] = None
+    status: RecordStatus = "recording"
+    start_time: tp.Optional[datetime] = None
+    end_time: tp.Optional[datetime] = None
+    thumbnail: tp.Optional[str] = None
+    ipfs_cid: tp.Optional[str] = None
+    ipfs_link: tp.Optional[str] = None
+    updated_at: datetime = Field(default_factory=datetime.now)
@@ -1,11 +1,13 @@
 import io
-import os
-import re
+import itertools
+import multiprocessing
 import textwrap
+import threading
 import typing as tp
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from statistics import mean
 from string import ascii_letters
-from subprocess import check_output
 
 from PIL import Image, ImageDraw, ImageFont
 from PIL.ImageFont import FreeTypeFont
@@ -13,88 +15,221 @@ from brother_ql import BrotherQLRaster, conversion
 from brother_ql.backends.helpers import send
 from loguru import logger
 
-from ..shared.Singleton import SingletonMeta
+from .discovery import UsbDiscovery
+from .templates import get_digest, templates
+from ..shared.cache import LRUCache
 from ..shared.config import config
+from ..shared.config_models import PrinterConfigSection
 
+FONT_PATH = "src/printing/fonts/helvetica-cyrillic-bold.ttf"
+FONT_SIZE = 24
+LAYOUT_CACHE_SIZE = 1024  # annotations usually repeat within a shift
+IMAGE_CACHE_SIZE = 16  # decoded and resized images, the labels are mostly made of a few base images
 
-class Printer(metaclass=SingletonMeta):
-    """a printing task for the label printer. executed at init"""
+Label = tp.Tuple[bytes, tp.Optional[str]]  # image data and annotation
+RasterKey = tp.Tuple[str, tp.Optional[str], str, str, bool]  # image hash, annotation, model, paper width, red
 
-    def __init__(self) -> None:
-        self._paper_width: str = str(config.printer.paper_width)
-        self._model: str = config.printer.printer_model
-        self._enabled: bool = config.printer.enable
+
+@lru_cache(maxsize=None)
+def _get_font(path: str, size: int) -> FreeTypeFont:
+    return ImageFont.truetype(path, size)
+
+
+@lru_cache(maxsize=None)
+def _get_avg_char_width(path: str, size: int) -> float:
+    font = _get_font(path, size)
+    return float(mean(font.getsize(char)[0] for char in ascii_letters))
+
+
+@lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _layout_text(text: str, width: int) -> tp.Tuple[str, int]:
+    """wrap the annotation to fit the image width and get the height of the wrapped text"""
+    font = _get_font(FONT_PATH, FONT_SIZE)
+    max_chars_in_line: int = int(width * 0.95 / _get_avg_char_width(FONT_PATH, FONT_SIZE))
+    wrapped_text: str = textwrap.fill(text, max_chars_in_line)
+
+    # get message size
+    sample_draw: ImageDraw.Draw = ImageDraw.Draw(Image.new(mode="1", size=(1, 1)))
+    _, txt_h = sample_draw.textsize(wrapped_text, font)
+    # https://stackoverflow.com/questions/59008322/pillow-imagedraw-text-coordinates-to-center/59008967#59008967
+    txt_h += font.getoffset(text)[1]
+    return wrapped_text, txt_h
+
+
+images: LRUCache[tp.Tuple[str, str], Image] = LRUCache(IMAGE_CACHE_SIZE)
+rasters: LRUCache[RasterKey, bytes] = LRUCache(config.printer.raster_cache_size)
+
+
+_render_pool: tp.Optional[ProcessPoolExecutor] = None
+_render_pool_lock = threading.Lock()
+
+
+def forget_image(digest: str) -> None:
+    """drop the cached renders of the image with the provided content hash"""
+    images.invalidate(lambda key: key[0] == digest)
+    rasters.invalidate(lambda key: key[0] == digest)
+
+
+def _prepare_image(image_data: tp.Union[str, bytes], paper_width: str) -> Image:
+    """decode the image and resize it to the paper width"""
+    if isinstance(image_data, str):
+        image: Image = Image.open(image_data)
+    else:
+        image = Image.open(io.BytesIO(image_data))
+
+    w, h = image.size
+    target_w = 696 if paper_width == "62" else 554
+    target_h = int(h * (target_w / w))
+    image = image.resize((target_w, target_h))
+    return image
+
+
+def _render_label(image_data: bytes, annotation: tp.Optional[str], paper_width: str) -> Image:
+    """prepare and annotate a label of a batch, runs in the render pool"""
+    image = _prepare_image(image_data, paper_width)
+    return Printer._annotate_image(image, annotation) if annotation else image
+
+
+def _get_render_pool() -> ProcessPoolExecutor:
+    """
+    the worker processes are started by a fork server rather than forked from the server process, which runs
+    threads and an event loop that a forked child could inherit in a broken state
+    """
+    global _render_pool
+
+    with _render_pool_lock:
+        if _render_pool is None:
+            context = multiprocessing.get_context("forkserver")
+            _render_pool = ProcessPoolExecutor(config.printer.render_workers, mp_context=context)
+
+        return _render_pool
+
+
+def start_render_pool() -> None:
+    """start the worker processes in advance, so that the first batch is not delayed by the start"""
+    _get_render_pool().submit(int)
+
+
+def shutdown_render_pool() -> None:
+    global _render_pool
+
+    with _render_pool_lock:
+        if _render_pool is not None:
+            _render_pool.shutdown()
+            _render_pool = None
+
+
+class Printer:
+    """a label printer. the rendered labels are cached and shared by all the printers"""
+
+    def __init__(self, settings: PrinterConfigSection) -> None:
+        self.name: str = settings.name
+        self._paper_width: str = str(settings.paper_width)
+        self._model: str = settings.printer_model
+        self._enabled: bool = settings.enable
+        self._red: bool = settings.red
+        self._discovery = UsbDiscovery(self._model, settings.address)
+        self._lock = threading.Lock()  # the raster data of concurrent jobs must not interleave on the device
 
     @property
     def _address(self) -> tp.Optional[str]:
         """Get printer USB bus address"""
-        try:
-            command: str = f'lsusb | grep "{self._model}"'
-            output: str = check_output(command, shell=True, text=True)
-            addresses: tp.List[str] = re.findall("[0-9a-fA-F]{4}:[0-9a-fA-F]{4}", output)
-            address: tp.List[str] = addresses[0].split(":")
-            bus_address: str = f"usb://0x{address[0]}:0x{address[1]}"
-            return bus_address
-
-        except Exception as e:
-            logger.warning("Could not get the printer USB bus address. The printer may be disconnected.")
-            logger.debug(f"An error occurred while parsing USB address: {e}")
-            return None
+        return self._discovery.address
+
+    @property
+    def is_available(self) -> bool:
+        """enabled in config and connected"""
+        return self._enabled and self._address is not None
 
     def print_image(self, image_data: tp.Union[str, bytes], annotation: tp.Optional[str] = None) -> None:
         """execute the task"""
-        if not all((self._enabled, self._address)):
-            message = "Printer disabled in config or disconnected. Task dropped."
-            logger.info("Printer disabled in config or disconnected. Task dropped.")
+        if isinstance(image_data, str):
+            with open(image_data, "rb") as f:
+                image_data = f.read()
+
+        data: bytes = image_data
+        self._print(get_digest(data), lambda: data, annotation)
+
+    def print_template(self, template_id: str, annotation: tp.Optional[str] = None) -> None:
+        """print a label template with the annotation"""
+        self._print(template_id, lambda: templates.get(template_id), annotation)
+
+    def print_batch(self, labels: tp.List[Label]) -> None:
+        """print the labels as a single multi-page job, the labels are rendered in parallel"""
+        if not self.is_available:
+            message = f"Printer {self.name} disabled in config or disconnected. Task dropped."
+            logger.info(message)
             raise BrokenPipeError(message)
 
-        logger.info("Printing task created for image")
+        logger.info(f"Printing a batch of {len(labels)} labels on printer {self.name}")
+
+        keys = [(get_digest(image_data), annotation) for image_data, annotation in labels]
+        # identical labels, e.g. serial numbers printed twice, are rendered once
+        unique_labels = dict(zip(keys, labels))
+        rendered_images = _get_render_pool().map(
+            _render_label,
+            [image_data for image_data, _ in unique_labels.values()],
+            [annotation for _, annotation in unique_labels.values()],
+            itertools.repeat(self._paper_width),
+        )
+        rendered = dict(zip(unique_labels, rendered_images))
+        pages = [rendered[key] for key in keys]
 
-        image: Image = self._get_image(image_data)
+        qlr: BrotherQLRaster = BrotherQLRaster(self._model)
+        conversion.convert(qlr, pages, self._paper_width, red=self._red)
+
+        with self._lock:
+            self._send(bytes(qlr.data))
+
+        logger.info("Printing task done")
+
+    def _print(self, digest: str, get_image_data: tp.Callable[[], bytes], annotation: tp.Optional[str]) -> None:
+        """print the image with the provided content hash, the image data is only loaded if it is not cached"""
+        if not self.is_available:
+            message = f"Printer {self.name} disabled in config or disconnected. Task dropped."
+            logger.info(message)
+            raise BrokenPipeError(message)
+
+        logger.info(f"Printing task created for image on printer {self.name}")
+
+        key = (digest, annotation, self._model, self._paper_width, self._red)
+        instructions = rasters.get(key, lambda: self._render(digest, get_image_data, annotation))
+
+        with self._lock:
+            self._send(instructions)
+
+        logger.info("Printing task done")
+
+    def _render(self, digest: str, get_image_data: tp.Callable[[], bytes], annotation: tp.Optional[str]) -> bytes:
+        """get the raster instructions for the image, the decoded and resized image is cached separately"""
+        image: Image = images.get((digest, self._paper_width), lambda: self._get_image(get_image_data()))
 
         if annotation:
             image = self._annotate_image(image, annotation)
 
-        self._print_image(image)
-        logger.info("Printing task done")
+        logger.info(f"Rendering image of size {image.size}")
+        qlr: BrotherQLRaster = BrotherQLRaster(self._model)
+        conversion.convert(qlr, [image], self._paper_width, red=self._red)
+        return bytes(qlr.data)
 
     def _get_image(self, image_data: tp.Union[str, bytes]) -> Image:
         """prepare and resize the image before printing"""
-        if isinstance(image_data, str):
-            image: Image = Image.open(image_data)
-        else:
-            image = Image.open(io.BytesIO(image_data))
-
-        w, h = image.size
-        target_w = 696 if self._paper_width == "62" else 554
-        target_h = int(h * (target_w / w))
-        image = image.resize((target_w, target_h))
-        return image
-
-    def _print_image(self, image: Image) -> None:
-        """print provided image"""
-        logger.info(f"Printing image of size {image.size}")
-        qlr: BrotherQLRaster = BrotherQLRaster(self._model)
-        red: bool = config.printer.red
-        conversion.convert(qlr, [image], self._paper_width, red=red)
-
-        # need to provide multiple fallbacks as the QL library us pretty unstable
-        # while printer keeps getting different addresses so we need to try them all
-        directory = "/dev/usb"
-        usb_devices = (f"{directory}/{desc}" for desc in os.listdir(directory) if desc.startswith("lp"))
-        backends = [("linux_kernel", dev) for dev in usb_devices]
-        backends.insert(0, ("pyusb", str(self._address)))
+        return _prepare_image(image_data, self._paper_width)
+
+    def _send(self, instructions: bytes) -> None:
+        """send the raster instructions to the printer"""
         success = False
 
-        for backend, address in backends:
+        for backend, address in self._discovery.backends:
             try:
                 status = send(
-                    instructions=qlr.data,
+                    instructions=instructions,
                     backend_identifier=backend,
                     printer_identifier=address,
                 )
                 logger.debug(f"Printing succeeded using {backend=}, {address=}.")
                 logger.debug(f"Job status: {status}")
+                self._discovery.remember((backend, address))
                 success = True
                 break
 
@@ -102,23 +237,15 @@ class Printer(metaclass=SingletonMeta):
                 logger.warning(f"Execution of 'brother_ql.backends.helpers.send()' failed. {backend=}, {address=}. {e}")
 
         if not success:
+            self._discovery.invalidate()
             raise BrokenPipeError("Printing failed. No backend was able to to handle the task.")
 
     @staticmethod
     def _annotate_image(image: Image, text: str) -> Image:
         """add an annotation to the bottom of the image"""
-        # wrap the message
-        font: FreeTypeFont = ImageFont.truetype("src/printing/fonts/helvetica-cyrillic-bold.ttf", 24)
-        avg_char_width: float = mean((font.getsize(char)[0] for char in ascii_letters))
+        font: FreeTypeFont = _get_font(FONT_PATH, FONT_SIZE)
         img_w, img_h = image.size
-        max_chars_in_line: int = int(img_w * 0.95 / avg_char_width)
-        wrapped_text: str = textwrap.fill(text, max_chars_in_line)
-
-        # get message size
-        sample_draw: ImageDraw.Draw = ImageDraw.Draw(image)
-        _, txt_h = sample_draw.textsize(wrapped_text, font)
-        # https://stackoverflow.com/questions/59008322/pillow-imagedraw-text-coordinates-to-center/59008967#59008967
-        txt_h += font.getoffset(text)[1]
+        wrapped_text, txt_h = _layout_text(text, img_w)
 
         # draw the message
         annotated_image: Image = Image.new(mode="RGB", size=(img_w, img_h + txt_h + 5), color=(255, 255, 255))
@@ -1,32 +1,279 @@
+import asyncio
 import typing as tp
 
 from fastapi import APIRouter, File, Form, status
 from loguru import logger
 
-from ._Printer import Printer
-from .models import GenericResponse
+from ._Printer import Label, Printer, forget_image, shutdown_render_pool, start_render_pool
+from .models import (
+    GenericResponse,
+    PrinterList,
+    PrinterModel,
+    PrintJobData,
+    PrintJobResponse,
+    TemplateList,
+    TemplateResponse,
+)
+from .pool import PrinterPool
+from .print_queue import PrintJob
+from .templates import templates
+from ..shared.config import config, printer_config
 
 router = APIRouter()
+printer_pool = PrinterPool([Printer(section) for section in printer_config], config.printer.queue_size)
 
 
-@router.post("/print_image", response_model=GenericResponse)
-def print_image(image_file: bytes = File(...), annotation: tp.Optional[str] = Form(None)) -> GenericResponse:
-    """Print an image using label printer and annotate if necessary"""
+def _to_job_data(job: PrintJob, message: str) -> PrintJobData:
+    return PrintJobData(
+        status=status.HTTP_200_OK,
+        details=message,
+        job_id=job.job_id,
+        job_status=job.status,
+        printer=job.printer,
+        error=job.error,
+        created_at=job.created_at,
+        finished_at=job.finished_at,
+        queue_length=len(printer_pool.queues[job.printer]) if job.printer is not None else 0,
+    )
+
+
+@router.post("/print_image", response_model=tp.Union[PrintJobResponse, GenericResponse])  # type: ignore
+async def print_image(
+    image_file: bytes = File(...), annotation: tp.Optional[str] = Form(None), printer: tp.Optional[str] = Form(None)
+) -> tp.Union[PrintJobResponse, GenericResponse]:
+    """
+    Queue an image for printing using label printer and annotate if necessary
+
+    Returns at once with the id of the print job, which can be used to follow or cancel it.
+    The job goes to the least busy printer unless a printer is requested by name.
+    """
+    try:
+        job = printer_pool.submit(image_file, annotation, printer=printer)
+        message = f"Print job {job.job_id} queued"
+        logger.info(message)
+        return PrintJobResponse(status=status.HTTP_200_OK, details=message, job_id=job.job_id)
+
+    except asyncio.QueueFull:
+        message = f"The print queue is full ({config.printer.queue_size} jobs). Try again later."
+        logger.warning(message)
+        return GenericResponse(status=status.HTTP_503_SERVICE_UNAVAILABLE, details=message)
+
+    except BrokenPipeError as e:
+        logger.warning(str(e))
+        return GenericResponse(status=status.HTTP_503_SERVICE_UNAVAILABLE, details=str(e))
+
+    except ValueError as e:
+        return GenericResponse(status=status.HTTP_404_NOT_FOUND, details=str(e))
+
+    except Exception as e:
+        message = f"An error occurred while queueing the image: {e}"
+        logger.error(message)
+        return GenericResponse(status=status.HTTP_500_INTERNAL_SERVER_ERROR, details=message)
+
+
+def _get_batch_labels(
+    image_files: tp.List[bytes], annotations: tp.List[str], template_id: tp.Optional[str]
+) -> tp.List[Label]:
+    """pair the images with the annotations, a single image or a template is used for every annotation"""
+    if template_id is not None:
+        if image_files:
+            raise ValueError("Either image files or a template can be printed, not both")
+
+        image_files = [templates.get(template_id)]
+
+    if not image_files:
+        raise ValueError("No images to print")
+
+    if len(image_files) == 1 and annotations:
+        labels: tp.List[Label] = [(image_files[0], annotation) for annotation in annotations]
+    elif not annotations:
+        labels = [(image_data, None) for image_data in image_files]
+    elif len(annotations) == len(image_files):
+        labels = list(zip(image_files, annotations))
+    else:
+        raise ValueError(f"Got {len(image_files)} images for {len(annotations)} annotations")
+
+    if len(labels) > config.printer.max_batch_size:
+        raise ValueError(f"Too many labels in the batch: {len(labels)}, at most {config.printer.max_batch_size}")
+
+    return labels
+
+
+@router.post("/print_batch", response_model=tp.Union[PrintJobResponse, GenericResponse])  # type: ignore
+async def print_batch(
+    image_files: tp.List[bytes] = File([]),
+    annotations: tp.List[str] = Form([]),
+    template_id: tp.Optional[str] = Form(None),
+    printer: tp.Optional[str] = Form(None),
+) -> tp.Union[PrintJobResponse, GenericResponse]:
+    """
+    Queue many labels for printing as a single job
+
+    The images are paired with the annotations in order. A single image or a template is printed once
+    per annotation, e.g. with a list of serial numbers. The labels are printed as one multi-page job.
+    """
+    try:
+        labels = _get_batch_labels(image_files, annotations, template_id)
+    except ValueError as e:
+        message = f"Invalid batch: {e}"
+        logger.error(message)
+        return GenericResponse(status=status.HTTP_400_BAD_REQUEST, details=message)
+
+    try:
+        job = printer_pool.submit(b"", printer=printer, batch=labels)
+        message = f"Print job {job.job_id} of {len(labels)} labels queued"
+        logger.info(message)
+        return PrintJobResponse(status=status.HTTP_200_OK, details=message, job_id=job.job_id)
+
+    except asyncio.QueueFull:
+        message = f"The print queue is full ({config.printer.queue_size} jobs). Try again later."
+        logger.warning(message)
+        return GenericResponse(status=status.HTTP_503_SERVICE_UNAVAILABLE, details=message)
+
+    except BrokenPipeError as e:
+        logger.warning(str(e))
+        return GenericResponse(status=status.HTTP_503_SERVICE_UNAVAILABLE, details=str(e))
+
+    except ValueError as e:
+        return GenericResponse(status=status.HTTP_404_NOT_FOUND, details=str(e))
+
+    except Exception as e:
+        message = f"An error occurred while queueing the batch: {e}"
+        logger.error(message)
+        return GenericResponse(status=status.HTTP_500_INTERNAL_SERVER_ERROR, details=message)
+
+
+@router.post("/templates", response_model=tp.Union[TemplateResponse, GenericResponse])  # type: ignore
+def add_template(image_file: bytes = File(...)) -> tp.Union[TemplateResponse, GenericResponse]:
+    """Upload a label template: a base image printed many times with varying annotations"""
+    try:
+        template_id = templates.add(image_file)
+        message = f"Saved label template {template_id}"
+        return TemplateResponse(status=status.HTTP_200_OK, details=message, template_id=template_id)
+
+    except ValueError as e:
+        message = f"Failed to save the label template: {e}"
+        logger.error(message)
+        return GenericResponse(status=status.HTTP_400_BAD_REQUEST, details=message)
+
+
+@router.get("/templates", response_model=TemplateList)
+def get_templates() -> TemplateList:
+    """List the label templates"""
+    template_ids = templates.list()
+    message = f"Collected {len(template_ids)} label templates"
+    return TemplateList(status=status.HTTP_200_OK, details=message, template_ids=template_ids)
+
+
+@router.delete("/templates/{template_id}", response_model=GenericResponse)
+def delete_template(template_id: str) -> GenericResponse:
+    """Delete a label template"""
     try:
-        Printer().print_image(image_file, annotation)
-        message = "Task handled as expected"
+        templates.delete(template_id)
+        forget_image(template_id)
+        return GenericResponse(status=status.HTTP_200_OK, details=f"Deleted label template {template_id}")
+
+    except ValueError as e:
+        return GenericResponse(status=status.HTTP_404_NOT_FOUND, details=str(e))
+
+
+@router.post(
+    "/templates/{template_id}/print", response_model=tp.Union[PrintJobResponse, GenericResponse]  # type: ignore
+)
+async def print_template(
+    template_id: str, annotation: tp.Optional[str] = Form(None), printer: tp.Optional[str] = Form(None)
+) -> tp.Union[PrintJobResponse, GenericResponse]:
+    """
+    Queue a label template for printing with the annotation
+
+    Repeated prints of the same template and annotation reuse the rendered label.
+    """
+    if template_id not in templates:
+        return GenericResponse(
+            status=status.HTTP_404_NOT_FOUND, details=f"No label template found for id {template_id}"
+        )
+
+    try:
+        job = printer_pool.submit(b"", annotation, template_id, printer)
+        message = f"Print job {job.job_id} queued"
         logger.info(message)
-        return GenericResponse(status=status.HTTP_200_OK, details=message)
+        return PrintJobResponse(status=status.HTTP_200_OK, details=message, job_id=job.job_id)
+
+    except asyncio.QueueFull:
+        message = f"The print queue is full ({config.printer.queue_size} jobs). Try again later."
+        logger.warning(message)
+        return GenericResponse(status=status.HTTP_503_SERVICE_UNAVAILABLE, details=message)
+
+    except BrokenPipeError as e:
+        logger.warning(str(e))
+        return GenericResponse(status=status.HTTP_503_SERVICE_UNAVAILABLE, details=str(e))
+
+    except ValueError as e:
+        return GenericResponse(status=status.HTTP_404_NOT_FOUND, details=str(e))
 
     except Exception as e:
-        message = f"An error occurred while printing the image: {e}"
+        message = f"An error occurred while queueing the template: {e}"
         logger.error(message)
         return GenericResponse(status=status.HTTP_500_INTERNAL_SERVER_ERROR, details=message)
 
 
+@router.get("/printers", response_model=PrinterList)
+def get_printers() -> PrinterList:
+    """List the printers and their load"""
+    printers = [
+        PrinterModel(
+            name=name,
+            is_available=queue.is_available,
+            is_printing=queue.is_printing,
+            queue_length=len(queue),
+        )
+        for name, queue in printer_pool.queues.items()
+    ]
+    message = f"Collected {len(printers)} printers"
+    return PrinterList(status=status.HTTP_200_OK, details=message, printers=printers)
+
+
+@router.get("/jobs/{job_id}", response_model=tp.Union[PrintJobData, GenericResponse])  # type: ignore
+def get_print_job(job_id: str) -> tp.Union[PrintJobData, GenericResponse]:
+    """Get the status of a print job"""
+    try:
+        job = printer_pool.get_job(job_id)
+        return _to_job_data(job, f"Print job {job_id} is {job.status}")
+
+    except ValueError as e:
+        return GenericResponse(status=status.HTTP_404_NOT_FOUND, details=str(e))
+
+
+@router.post("/jobs/{job_id}/cancel", response_model=tp.Union[PrintJobData, GenericResponse])  # type: ignore
+def cancel_print_job(job_id: str) -> tp.Union[PrintJobData, GenericResponse]:
+    """Cancel a print job which has not started printing yet"""
+    try:
+        job = printer_pool.cancel(job_id)
+        message = f"Print job {job_id} cancelled"
+        logger.info(message)
+        return _to_job_data(job, message)
+
+    except ValueError as e:
+        message = f"Failed to cancel print job {job_id}: {e}"
+        logger.error(message)
+        return GenericResponse(status=status.HTTP_400_BAD_REQUEST, details=message)
+
+
 @router.on_event("startup")
 @logger.catch(reraise=True)
-def startup_event() -> None:
+async def startup_event() -> None:
     """tasks to do at server startup"""
-    Printer()
-    logger.info("Initialized printer")
+    printer_pool.start()
+    start_render_pool()
+    logger.info(f"Initialized {len(printer_pool.queues)} printers")
+
+
+@router.on_event("shutdown")
+@logger.catch(reraise=True)
+async def shutdown_event() -> None:
+    """tasks to do at server shutdown"""
+    if len(printer_pool):
+        logger.warning(f"{len(printer_pool)} print jobs were dropped due to server shutdown")
+
+    await printer_pool.stop()
+    shutdown_render_pool()
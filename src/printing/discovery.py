@@ -0,0 +1,119 @@
+import glob
+import os
+import re
+import typing as tp
+from subprocess import check_output
+from time import monotonic
+
+from loguru import logger
+
+USB_DEVICE_DIRS = "/dev/bus/usb/*"  # device nodes are added and removed here on hotplug
+LP_DEVICE_DIR = "/dev/usb"
+NOT_FOUND_TTL = 10.0  # a missing printer is looked up again after that many seconds even without a hotplug event
+
+Backend = tp.Tuple[str, str]  # a brother_ql backend identifier and a printer identifier for it
+
+
+class UsbDiscovery:
+    """
+    Finds the printer on the USB bus and caches the result.
+
+    The lookup is repeated only when a device is plugged in or out, which is detected by the change
+    of the USB device directories, after a failed send or, while the printer is missing, every
+    NOT_FOUND_TTL seconds. The backend which handled the last job is tried first next time.
+
+    If there are several printers of the same model, each one is pinned to its address: a pyusb
+    identifier with the serial number (usb://0x04f9:0x209b/000G0Z123456) or a /dev/usb/lp* device.
+    Only that address is used then.
+    """
+
+    def __init__(self, model: str, address: tp.Optional[str] = None) -> None:
+        self._model = model
+        self._fixed_address = address  # set to tell apart several printers of the same model
+        self._address: tp.Optional[str] = None
+        self._backends: tp.Optional[tp.List[Backend]] = None
+        self._last_backend: tp.Optional[Backend] = None
+        self._hotplug_stamp: tp.Optional[tp.Tuple[float, ...]] = None
+        self._resolved_at: float = 0.0
+
+    @staticmethod
+    def _get_hotplug_stamp() -> tp.Tuple[float, ...]:
+        """a few stat calls that change whenever a USB device node is added or removed"""
+        paths = [LP_DEVICE_DIR, *sorted(glob.glob(USB_DEVICE_DIRS))]
+        return tuple(os.stat(path).st_mtime if os.path.exists(path) else 0.0 for path in paths)
+
+    def _find_address(self) -> tp.Optional[str]:
+        """get the printer USB bus address from lsusb"""
+        if self._fixed_address is not None and not self._fixed_address.startswith("usb://"):
+            return self._fixed_address if os.path.exists(self._fixed_address) else None
+
+        try:
+            output: str = check_output(["lsusb"], text=True)
+            line = next(line for line in output.splitlines() if self._model in line)
+            vendor, product = re.findall("[0-9a-fA-F]{4}:[0-9a-fA-F]{4}", line)[0].split(":")
+            return self._fixed_address or f"usb://0x{vendor}:0x{product}"
+
+        except Exception as e:
+            logger.warning("Could not get the printer USB bus address. The printer may be disconnected.")
+            logger.debug(f"An error occurred while parsing USB address: {e}")
+            return None
+
+    @staticmethod
+    def _find_lp_devices() -> tp.List[str]:
+        if not os.path.isdir(LP_DEVICE_DIR):
+            return []
+
+        return [f"{LP_DEVICE_DIR}/{desc}" for desc in sorted(os.listdir(LP_DEVICE_DIR)) if desc.startswith("lp")]
+
+    def _refresh_if_needed(self) -> None:
+        stamp = self._get_hotplug_stamp()
+        is_stale = self._address is None and monotonic() - self._resolved_at > NOT_FOUND_TTL
+
+        if stamp == self._hotplug_stamp and not is_stale:
+            return
+
+        if self._hotplug_stamp is not None and stamp != self._hotplug_stamp:
+            logger.info("USB devices changed, looking the printer up again")
+
+        self._hotplug_stamp, self._resolved_at = stamp, monotonic()
+        self._address = self._find_address()
+        self._backends = None
+
+    @property
+    def address(self) -> tp.Optional[str]:
+        """the printer USB bus address, None if the printer is not connected"""
+        self._refresh_if_needed()
+        return self._address
+
+    @property
+    def backends(self) -> tp.List[Backend]:
+        """
+        the backends to try sending a job with, the one that worked last time goes first
+
+        need to provide multiple fallbacks as the QL library is pretty unstable
+        while printer keeps getting different addresses so we need to try them all
+        """
+        self._refresh_if_needed()
+
+        if self._fixed_address is not None:
+            backend = "pyusb" if self._fixed_address.startswith("usb://") else "linux_kernel"
+            return [(backend, self._fixed_address)]
+
+        if self._backends is None:
+            self._backends = [("pyusb", str(self._address))]
+            self._backends.extend(("linux_kernel", device) for device in self._find_lp_devices())
+
+        if self._last_backend in self._backends:
+            return [self._last_backend, *(backend for backend in self._backends if backend != self._last_backend)]
+
+        return list(self._backends)
+
+    def remember(self, backend: Backend) -> None:
+        """note the backend that handled the job"""
+        self._last_backend = backend
+
+    def invalidate(self) -> None:
+        """look the printer up again on the next access, after a failed send"""
+        self._hotplug_stamp = None
+        self._last_backend = None
+        self._backends = None
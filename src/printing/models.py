@@ -1,6 +1,42 @@
+import typing as tp
+from datetime import datetime
+
 from pydantic import BaseModel
 
 
 class GenericResponse(BaseModel):
     status: int
     details: str
+
+
+class PrintJobResponse(GenericResponse):
+    job_id: str
+
+
+class PrintJobData(GenericResponse):
+    job_id: str
+    job_status: str
+    printer: tp.Optional[str]  # the printer the job is queued to
+    error: tp.Optional[str]
+    created_at: datetime
+    finished_at: tp.Optional[datetime]
+    queue_length: int  # jobs waiting to be printed
+
+
+class TemplateResponse(GenericResponse):
+    template_id: str
+
+
+class TemplateList(GenericResponse):
+    template_ids: tp.List[str]
+
+
+class PrinterModel(BaseModel):
+    name: str
+    is_available: bool  # enabled in config and connected
+    is_printing: bool
+    queue_length: int
+
+
+class PrinterList(GenericResponse):
+    printers: tp.List[PrinterModel]
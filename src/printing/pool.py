@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import typing as tp
+from time import monotonic
+
+from loguru import logger
+
+from ._Printer import Label, Printer
+from .print_queue import PrintJob, PrintQueue
+
+FAILURE_COOLDOWN_SEC = 30.0  # a printer that failed a job is not dispatched to for that long, unless it is the only one
+
+
+class PrinterPool:
+    """
+    The label printers of the station, each with its own print queue.
+
+    A job goes to the printer it is requested for or to the least busy available one otherwise. If the
+    printer fails to send the job, the job is handed over to another available printer, unless it was
+    requested for that very printer.
+    """
+
+    def __init__(self, printers: tp.List[Printer], queue_size: int) -> None:
+        self.queues: tp.Dict[str, PrintQueue] = {
+            printer.name: PrintQueue(printer, queue_size, self._failover) for printer in printers
+        }
+        self._failed_at: tp.Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        """the number of jobs waiting to be printed"""
+        return sum(len(queue) for queue in self.queues.values())
+
+    def start(self) -> None:
+        for queue in self.queues.values():
+            queue.start()
+
+    async def stop(self) -> None:
+        for queue in self.queues.values():
+            await queue.stop()
+
+    def _get_queue(self, printer: str) -> PrintQueue:
+        try:
+            return self.queues[printer]
+        except KeyError:
+            raise ValueError(f"No printer found with name {printer}")
+
+    def _is_cooling_down(self, printer: str) -> bool:
+        return printer in self._failed_at and monotonic() - self._failed_at[printer] < FAILURE_COOLDOWN_SEC
+
+    def _choose(self, exclude: tp.Collection[str] = ()) -> PrintQueue:
+        """get the queue of the least busy available printer, the recently failed ones are the last resort"""
+        available = [queue for name, queue in self.queues.items() if name not in exclude and queue.is_available]
+
+        if not available:
+            raise BrokenPipeError("No printer is available. The printers are disabled in config or disconnected.")
+
+        return min(
+            available, key=lambda queue: (self._is_cooling_down(queue.printer.name), len(queue), queue.is_printing)
+        )
+
+    def submit(
+        self,
+        image_data: bytes,
+        annotation: tp.Optional[str] = None,
+        template_id: tp.Optional[str] = None,
+        printer: tp.Optional[str] = None,
+        batch: tp.Optional[tp.List[Label]] = None,
+    ) -> PrintJob:
+        """
+        queue the job to the printer or to the least busy one, raises asyncio.QueueFull if the queue is full
+        and BrokenPipeError if no printer is available to take it
+        """
+        queue = self._get_queue(printer) if printer is not None else self._choose()
+        job = queue.submit(image_data, annotation, template_id, batch)
+        job.targeted = printer is not None
+        return job
+
+    def get_job(self, job_id: str) -> PrintJob:
+        for queue in self.queues.values():
+            try:
+                return queue.get_job(job_id)
+            except ValueError:
+                pass
+
+        raise ValueError(f"No print job found for id {job_id}")
+
+    def cancel(self, job_id: str) -> PrintJob:
+        job = self.get_job(job_id)
+        assert job.printer is not None
+        return self.queues[job.printer].cancel(job_id)
+
+    def _failover(self, job: PrintJob) -> bool:
+        """hand the job the printer failed to send over to another printer, True if there is one"""
+        assert job.printer is not None
+        self._failed_at[job.printer] = monotonic()
+
+        if job.targeted:
+            return False
+
+        try:
+            queue = self._choose(exclude=job.tried)
+        except BrokenPipeError:
+            return False
+
+        logger.info(f"Print job {job.job_id} is moved from printer {job.printer} to printer {queue.printer.name}")
+        self.queues[job.printer].remove(job)
+        queue.put(job)
+        return True
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import asyncio
+import typing as tp
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from uuid import uuid4
+
+from loguru import logger
+
+from ._Printer import Label, Printer
+
+JOB_HISTORY_SIZE = 1000  # how many finished jobs are kept for the status queries
+AVAILABILITY_CHECK_SEC = 2.0  # how often the printer availability is refreshed, the USB lookup itself is cached
+
+PrintJobStatus = tp.Literal["queued", "printing", "done", "failed", "cancelled"]
+
+
+@dataclass
+class PrintJob:
+    image_data: bytes = field(repr=False)
+    annotation: tp.Optional[str] = None
+    template_id: tp.Optional[str] = None  # print the label template instead of the image data
+    batch: tp.Optional[tp.List[Label]] = field(default=None, repr=False)  # print the labels instead of the image
+    printer: tp.Optional[str] = None  # the printer the job is queued to
+    targeted: bool = False  # requested for the printer, so it is not failed over to another one
+    tried: tp.Set[str] = field(default_factory=set)  # the printers that failed to print the job
+    job_id: str = field(default_factory=lambda: uuid4().hex)
+    status: PrintJobStatus = "queued"
+    error: tp.Optional[str] = None
+    created_at: datetime = field(default_factory=datetime.now)
+    finished_at: tp.Optional[datetime] = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ("done", "failed", "cancelled")
+
+
+class PrintQueue:
+    """
+    A bounded queue of print jobs for a printer.
+
+    A single worker sends the jobs to the printer one by one, so the raster data of concurrent jobs
+    is never interleaved on the device. Jobs are submitted without waiting for the print and can be
+    cancelled until the printing starts. A full queue rejects new jobs, so the clients back off
+    instead of piling up images in memory.
+    """
+
+    def __init__(
+        self, printer: Printer, max_size: int, failover: tp.Optional[tp.Callable[[PrintJob], bool]] = None
+    ) -> None:
+        self.printer = printer
+        self.max_size = max_size
+        self.is_printing = False
+        self.is_available = False  # as of the last check, which may run lsusb and is thus done in a thread
+        self._failover = failover  # hands a job the printer failed to print over elsewhere, True if taken
+        self._jobs: tp.OrderedDict[str, PrintJob] = OrderedDict()
+        self._queue: tp.Optional[asyncio.Queue[str]] = None
+        self._worker: tp.Optional[asyncio.Task[None]] = None
+        self._monitor: tp.Optional[asyncio.Task[None]] = None
+
+    def __len__(self) -> int:
+        """the number of jobs waiting to be printed"""
+        return sum(job.status == "queued" for job in self._jobs.values())
+
+    @property
+    def queue(self) -> asyncio.Queue[str]:
+        """created lazily to be bound to the running loop"""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+
+        return self._queue
+
+    def start(self) -> None:
+        """start the worker and the availability monitor"""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._work())
+            self._monitor = asyncio.create_task(self._monitor_availability())
+            logger.info(f"Started the print queue worker, queue size is {self.max_size}")
+
+    async def stop(self) -> None:
+        """stop the worker, the queued jobs are dropped"""
+        tasks = [task for task in (self._worker, self._monitor) if task is not None]
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker, self._monitor = None, None
+
+    async def _monitor_availability(self) -> None:
+        """keep the availability flag up to date without blocking the event loop on the printer lookup"""
+        loop = asyncio.get_running_loop()
+
+        while True:
+            try:
+                self.is_available = await loop.run_in_executor(None, lambda: self.printer.is_available)
+            except Exception as e:
+                logger.error(f"Failed to check printer {self.printer.name} availability: {e}")
+                self.is_available = False
+
+            await asyncio.sleep(AVAILABILITY_CHECK_SEC)
+
+    def submit(
+        self,
+        image_data: bytes,
+        annotation: tp.Optional[str] = None,
+        template_id: tp.Optional[str] = None,
+        batch: tp.Optional[tp.List[Label]] = None,
+    ) -> PrintJob:
+        """
+        queue the image, the template or the batch for printing, raises asyncio.QueueFull if the queue is full
+        and BrokenPipeError if the printer is disabled or disconnected
+        """
+        if not self.is_available:
+            raise BrokenPipeError(f"Printer {self.printer.name} is disabled in config or disconnected")
+
+        if len(self) >= self.max_size:  # cancelled jobs left in the queue are not counted
+            raise asyncio.QueueFull
+
+        job = PrintJob(image_data, annotation, template_id, batch)
+        self.put(job)
+        return job
+
+    def put(self, job: PrintJob) -> None:
+        """queue an existing job regardless of the queue size"""
+        job.printer, job.status = self.printer.name, "queued"
+        self.queue.put_nowait(job.job_id)
+        self._jobs[job.job_id] = job
+        logger.info(f"Print job {job.job_id} queued to printer {self.printer.name}, {len(self)} jobs in the queue")
+
+    def remove(self, job: PrintJob) -> None:
+        self._jobs.pop(job.job_id, None)
+
+    def get_job(self, job_id: str) -> PrintJob:
+        try:
+            return self._jobs[job_id]
+        except KeyError:
+            raise ValueError(f"No print job found for id {job_id}")
+
+    def cancel(self, job_id: str) -> PrintJob:
+        """cancel the job unless it is being printed or is finished already"""
+        job = self.get_job(job_id)
+
+        if job.status != "queued":
+            raise ValueError(f"Print job {job_id} is {job.status} and cannot be cancelled")
+
+        self._finish(job, "cancelled")
+        return job
+
+    def _finish(self, job: PrintJob, job_status: PrintJobStatus, error: tp.Optional[str] = None) -> None:
+        job.status, job.error, job.finished_at = job_status, error, datetime.now()
+        job.image_data, job.batch = b"", None  # not needed anymore, the job is kept for the status queries only
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished]
+
+        for job_id in finished[: max(len(finished) - JOB_HISTORY_SIZE, 0)]:
+            del self._jobs[job_id]
+
+    async def _work(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            job = self._jobs.get(await self.queue.get())
+
+            if job is None or job.status != "queued":  # cancelled meanwhile
+                continue
+
+            job.status = "printing"
+            self.is_printing = True
+            logger.info(f"Printing job {job.job_id}")
+
+            try:
+                if job.batch is not None:
+                    await loop.run_in_executor(None, self.printer.print_batch, job.batch)
+                elif job.template_id is not None:
+                    await loop.run_in_executor(None, self.printer.print_template, job.template_id, job.annotation)
+                else:
+                    await loop.run_in_executor(None, self.printer.print_image, job.image_data, job.annotation)
+
+                self._finish(job, "done")
+                logger.info(f"Print job {job.job_id} done")
+            except BrokenPipeError as e:  # the printer is unavailable, another one may take the job
+                job.tried.add(self.printer.name)
+
+                if self._failover is not None and self._failover(job):
+                    logger.warning(f"Print job {job.job_id} failed on printer {self.printer.name}, failed over: {e}")
+                else:
+                    self._finish(job, "failed", str(e))
+                    logger.error(f"Print job {job.job_id} failed: {e}")
+            except Exception as e:
+                self._finish(job, "failed", str(e))
+                logger.error(f"Print job {job.job_id} failed: {e}")
+            finally:
+                self.is_printing = False
@@ -0,0 +1,75 @@
+import io
+import os
+import typing as tp
+from hashlib import sha256
+
+from PIL import Image
+from loguru import logger
+
+from ..shared.config import config
+
+
+def get_digest(image_data: bytes) -> str:
+    """the content hash images are cached by and templates are named after"""
+    return sha256(image_data).hexdigest()
+
+
+class TemplateStore:
+    """
+    Label templates: base images uploaded once and printed many times with varying annotations.
+
+    Templates are named after the hash of their content, so uploading the same image twice yields the same
+    template, and are kept on the disk to survive restarts.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def _get_path(self, template_id: str) -> str:
+        if not template_id.isalnum():
+            raise ValueError(f"Invalid template id {template_id}")
+
+        return os.path.join(self.directory, template_id)
+
+    def __contains__(self, template_id: str) -> bool:
+        return template_id.isalnum() and os.path.exists(self._get_path(template_id))
+
+    def add(self, image_data: bytes) -> str:
+        """save the template, return its id"""
+        try:
+            Image.open(io.BytesIO(image_data)).verify()
+        except Exception as e:
+            raise ValueError(f"Not a valid image: {e}")
+
+        template_id = get_digest(image_data)
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(self._get_path(template_id), "wb") as f:
+            f.write(image_data)
+
+        logger.info(f"Saved label template {template_id}")
+        return template_id
+
+    def get(self, template_id: str) -> bytes:
+        try:
+            with open(self._get_path(template_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise ValueError(f"No label template found for id {template_id}")
+
+    def list(self) -> tp.List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+
+        return sorted(os.listdir(self.directory))
+
+    def delete(self, template_id: str) -> None:
+        try:
+            os.remove(self._get_path(template_id))
+        except FileNotFoundError:
+            raise ValueError(f"No label template found for id {template_id}")
+
+        logger.info(f"Deleted label template {template_id}")
+
+
+templates = TemplateStore(config.printer.template_dir)
@@ -0,0 +1,146 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import typing as tp
+from collections import OrderedDict
+from time import monotonic
+
+K = tp.TypeVar("K")
+V = tp.TypeVar("V")
+
+
+class AsyncTTLCache(tp.Generic[K, V]):
+    """
+    An in-process LRU cache for the results of async lookups with an expiration time.
+
+    Concurrent lookups of the same missing key are coalesced into a single loader call.
+    Exceptions of the `negative` types raised by the loader are cached for `negative_ttl`
+    seconds, so repeated lookups of a nonexistent key do not hit the backend either.
+    """
+
+    def __init__(
+        self,
+        ttl: float,
+        max_size: int,
+        negative_ttl: float = 0,
+        negative: tp.Tuple[tp.Type[Exception], ...] = (),
+    ) -> None:
+        self._ttl = ttl
+        self._max_size = max_size
+        self._negative_ttl = negative_ttl
+        self._negative = negative
+        self._entries: tp.OrderedDict[K, tp.Tuple[float, tp.Union[V, Exception]]] = OrderedDict()
+        self._pending: tp.Dict[K, asyncio.Future[V]] = {}
+        self._generation = 0  # bumped on invalidation so that lookups in flight do not store stale values
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, key: K) -> tp.Optional[tp.Tuple[float, tp.Union[V, Exception]]]:
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        if entry[0] < monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key: K, value: tp.Union[V, Exception], ttl: float) -> None:
+        self._entries[key] = (monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, key: K, loader: tp.Callable[[K], tp.Awaitable[V]]) -> V:
+        """get the cached value for the key or load it using the loader"""
+        entry = self._lookup(key)
+
+        if entry is not None:
+            if isinstance(entry[1], Exception):
+                raise entry[1]
+
+            return entry[1]
+
+        if key in self._pending:
+            return await asyncio.shield(self._pending[key])
+
+        future: asyncio.Future[V] = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        generation = self._generation
+
+        try:
+            value = await loader(key)
+        except Exception as e:
+            if isinstance(e, self._negative) and self._negative_ttl > 0 and generation == self._generation:
+                self._store(key, e, self._negative_ttl)
+
+            future.set_exception(e)
+            future.exception()  # mark as retrieved in case nobody else is waiting
+            raise
+        else:
+            if generation == self._generation:
+                self._store(key, value, self._ttl)
+
+            future.set_result(value)
+            return value
+        finally:
+            del self._pending[key]
+
+            if not future.done():  # the loader was cancelled
+                future.cancel()
+
+    def invalidate(self, key: K) -> None:
+        """drop the cached value for the key"""
+        self._generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """drop all the cached values"""
+        self._generation += 1
+        self._entries.clear()
+
+
+class LRUCache(tp.Generic[K, V]):
+    """A thread-safe in-process LRU cache for the results of blocking computations"""
+
+    def __init__(self, max_size: int) -> None:
+        self._max_size = max_size
+        self._entries: tp.OrderedDict[K, V] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K, loader: tp.Callable[[], V]) -> V:
+        """get the cached value for the key or compute it using the loader"""
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+            self.misses += 1
+
+        value = loader()  # not under the lock, a concurrent miss for the same key just computes it twice
+
+        with self._lock:
+            self._entries[key] = value
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def invalidate(self, predicate: tp.Callable[[K], bool]) -> None:
+        """drop the cached values for the keys matching the predicate"""
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
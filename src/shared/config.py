@@ -1,10 +1,11 @@
+import os
 import typing as tp
 
 import pydantic
 import yaml
 from loguru import logger
 
-from .config_models import GlobalConfig, CameraConfigSection
+from .config_models import GlobalConfig, CameraConfigSection, PrinterConfigSection
 
 
 @logger.catch(reraise=True)
@@ -19,3 +20,39 @@ def _load_config(config_path: str, model) -> tp.Any:
 
 config: GlobalConfig = _load_config("src/config/config.yaml", GlobalConfig)
 camera_config: tp.List[CameraConfigSection] = _load_config("src/config/camera_config.yaml", tp.List[CameraConfigSection])
+
+
+def _check_printer_config(printers: tp.List[PrinterConfigSection]) -> None:
+    """the printers are told apart by name in the requests and by address on the bus, so both must be unique"""
+    names = [printer.name for printer in printers]
+
+    if len(set(names)) < len(names):
+        raise ValueError(f"Printer names must be unique, got {names}")
+
+    enabled = [printer for printer in printers if printer.enable]
+    addresses = [printer.address for printer in enabled if printer.address is not None]
+
+    if len(set(addresses)) < len(addresses):
+        raise ValueError(f"Printer addresses must be unique, got {addresses}")
+
+    for model in {printer.printer_model for printer in enabled}:
+        same_model = [printer.name for printer in enabled if printer.printer_model == model]
+        unaddressed = [printer.name for printer in enabled if printer.printer_model == model and not printer.address]
+
+        if len(same_model) > 1 and unaddressed:
+            raise ValueError(
+                f"Printers {same_model} are all {model}, set the address of {unaddressed} to tell them apart"
+            )
+
+
+def _load_printer_config(config_path: str) -> tp.List[PrinterConfigSection]:
+    """load the list of printers, a single printer is configured in the printer section of the global config if absent"""
+    if os.path.exists(config_path):
+        printers: tp.List[PrinterConfigSection] = _load_config(config_path, tp.List[PrinterConfigSection])
+        _check_printer_config(printers)
+        return printers
+
+    return [PrinterConfigSection(name="default", **config.printer.dict())]
+
+
+printer_config: tp.List[PrinterConfigSection] = _load_printer_config("src/config/printer_config.yaml")
@@ -1,3 +1,5 @@
+import typing as tp
+
 from pydantic import BaseModel
 
 
@@ -11,17 +13,28 @@ class ApiServer(ConfigSection):
 
 class MongoDB(ConfigSection):
     mongo_connection_url: str
+    employee_cache_ttl: float = 300  # for how long an authenticated employee is cached, seconds
+    employee_cache_negative_ttl: float = 10  # for how long an unknown card id is cached, seconds
+    employee_cache_size: int = 1024
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    server_selection_timeout_ms: int = 30000
+    read_preference: str = "primary"
+    slow_query_ms: float = 100  # queries running longer are logged
 
 
 class Pinata(ConfigSection):
     enable: bool
     pinata_api: str
     pinata_secret_api: str
+    workers: int = 2
 
 
 class Ipfs(ConfigSection):
     enable: bool
     gateway_address: str
+    api_address: str = "http://localhost:5001"
+    max_concurrent_uploads: int = 4
 
 
 class Yourls(ConfigSection):
@@ -35,10 +48,43 @@ class Printer(ConfigSection):
     paper_width: int
     enable: bool
     red: bool
+    queue_size: int = 16  # print jobs queued beyond that are rejected
+    raster_cache_size: int = 64  # rendered labels kept to be reprinted without rendering
+    template_dir: str = "output/label_templates"
+    max_batch_size: int = 100  # labels in a single batch print job
+    render_workers: tp.Optional[int] = None  # processes rendering the labels of batches, one per CPU if not set
 
 
 class Video(ConfigSection):
     delete_after_publishing: bool
+    camera_check_interval: float = 10  # how often camera reachability is checked, seconds
+    max_record_duration: float = 3600  # longer recordings are considered stuck and are stopped, seconds
+    # pull a camera stream once for all the concurrent recordings from it. Worth it only if recordings from the same
+    # camera overlap, as the videos are then cut from segments and a stop waits for the current segment to close
+    share_ingest: bool = False
+    segmented: bool = False  # record into a series of short segments instead of a single file
+    segment_duration: int = 10  # seconds
+    # keep segments as an HLS playlist, so the stop is instant, or join them into an mp4, which the stop waits for
+    segment_output: tp.Literal["mp4", "hls"] = "hls"
+    post_processing: bool = False  # process stopped recordings in the background, the stop returns at once
+    post_processing_workers: int = 2  # how many recordings are processed at the same time
+    faststart: bool = True  # remux mp4 videos for streaming
+    transcode_height: tp.Optional[int] = None  # downscale and re-encode videos to the height if set
+    transcode_preset: str = "veryfast"
+    transcode_crf: int = 23
+    thumbnail: bool = True
+    auto_publish: bool = False  # publish processed videos to IPFS and / or Pinata
+    buffer_dir: str = "/dev/shm/feecc-io-gateway"  # where camera buffers are kept, a tmpfs preferably
+
+
+class Storage(ConfigSection):
+    directories: tp.List[str] = ["output/video", "cache"]  # the directories kept in check
+    cache_directories: tp.List[str] = ["cache"]  # any file in these may be evicted, not only the published ones
+    quota_mb: tp.Optional[float] = None  # the managed directories may take at most that much together
+    min_free_mb: float = 1024  # files are evicted to keep that much disk space free
+    critical_free_mb: float = 256  # recordings are refused to start with less free space
+    max_age_days: tp.Optional[float] = None  # published files unused for longer are evicted
+    check_interval: float = 60  # how often the disk usage is checked, seconds
 
 
 class GlobalConfig(BaseModel):
@@ -49,6 +95,16 @@ class GlobalConfig(BaseModel):
     yourls: Yourls
     printer: Printer
     video: Video
+    storage: Storage = Storage()
+
+
+class PrinterConfigSection(ConfigSection):
+    name: str
+    printer_model: str
+    paper_width: int
+    enable: bool = True
+    red: bool = False
+    address: tp.Optional[str] = None  # the pyusb identifier with a serial number or the /dev/usb/lp* device
 
 
 class CameraConfigSection(ConfigSection):
@@ -56,3 +112,6 @@ class CameraConfigSection(ConfigSection):
     ip: str
     port: int
     rtsp_stream_link: str
+    buffer_duration: float = 0  # seconds of the stream kept in an always-on rolling buffer, 0 disables buffering
+    pre_roll: float = 0  # seconds of the buffer before the recording start to include into the video
+    max_duration: tp.Optional[float] = None  # seconds, overrides the video.max_record_duration for the camera
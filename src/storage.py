@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import re
+import shutil
+import typing as tp
+from dataclasses import dataclass, field
+from datetime import datetime
+from time import time
+
+from loguru import logger
+
+from .database import MongoDbWrapper
+from .shared.Singleton import SingletonMeta
+from .shared.config import config
+
+MB = 1024 * 1024
+RECORD_ID_PATTERN = re.compile(r"^([0-9a-f]{32})(\.|$)")  # recording files and segment directories are named by id
+
+
+@dataclass
+class StorageItem:
+    """a file or a directory in one of the managed directories, evicted as a whole"""
+
+    path: str
+    size: int
+    last_used: float  # the latest access or modification time
+    record_id: tp.Optional[str] = None
+
+
+@dataclass
+class DirectoryUsage:
+    path: str
+    used_bytes: int = 0
+    files: int = 0
+    evictable_bytes: int = 0  # taken by the files which can be evicted: published or cached ones
+    free_bytes: int = 0  # on the filesystem of the directory
+    total_bytes: int = 0
+    items: tp.List[StorageItem] = field(default_factory=list, repr=False)
+
+
+def get_size(path: str) -> int:
+    """the size of a file or the total size of the files in a directory"""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def _get_disk_usage(directory: str) -> tp.Tuple[int, int]:
+    """get the free and total space of the filesystem the directory is or will be created on"""
+    path = os.path.abspath(directory)
+
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+
+    disk = shutil.disk_usage(path)
+    return disk.free, disk.total
+
+
+def _scan(directory: str) -> DirectoryUsage:
+    """get the items in the directory and their sizes"""
+    usage = DirectoryUsage(directory)
+    usage.free_bytes, usage.total_bytes = _get_disk_usage(directory)
+
+    if not os.path.isdir(directory):
+        return usage
+
+    for entry in os.scandir(directory):
+        try:
+            stat = entry.stat()
+            size = get_size(entry.path)
+        except FileNotFoundError:
+            continue  # removed meanwhile
+
+        match = RECORD_ID_PATTERN.match(entry.name)
+        item = StorageItem(entry.path, size, max(stat.st_atime, stat.st_mtime), match.group(1) if match else None)
+        usage.items.append(item)
+        usage.used_bytes += size
+        usage.files += 1
+
+    return usage
+
+
+class StorageManager(metaclass=SingletonMeta):
+    """
+    Keeps the disk usage of the output and cache directories in check.
+
+    The directories are swept periodically: the published recordings older than the max age are evicted,
+    then the least recently used published recordings and cached files are evicted while the directories
+    exceed the quota or the free space is below the minimum. A file counts as published once it is
+    published by path, as recorded by the publishing itself. Recordings which are not published yet or
+    are still being pinned are never evicted.
+    """
+
+    def __init__(self) -> None:
+        self.usage: tp.List[DirectoryUsage] = []
+        self.evicted_files: int = 0
+        self.evicted_bytes: int = 0
+        self.last_sweep: tp.Optional[datetime] = None
+        self._lock: tp.Optional[asyncio.Lock] = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        """created lazily to be bound to the running loop"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        return self._lock
+
+    @property
+    def free_bytes(self) -> int:
+        """the least free space among the filesystems of the managed directories"""
+        directories = config.storage.directories or ["."]
+        return min(_get_disk_usage(directory)[0] for directory in directories)
+
+    async def _get_evictable(self, usage: DirectoryUsage) -> tp.List[StorageItem]:
+        """
+        get the items which are safe to remove: cached files, published files which have not changed since
+        and the other files of their recordings, unless they are being pinned
+        """
+        if os.path.normpath(usage.path) in map(os.path.normpath, config.storage.cache_directories):
+            return list(usage.items)
+
+        database = MongoDbWrapper()
+        published_files = await database.get_published_files(os.path.abspath(item.path) for item in usage.items)
+        pinning = [os.path.abspath(job.path) for job in await database.get_unfinished_pin_jobs()]
+
+        def is_published(item: StorageItem) -> bool:
+            published_file = published_files.get(os.path.abspath(item.path))
+            return published_file is not None and published_file.size == item.size
+
+        published_records = {
+            item.record_id for item in usage.items if item.record_id is not None and is_published(item)
+        }
+
+        return [
+            item
+            for item in usage.items
+            if (is_published(item) or item.record_id in published_records)
+            and not any(path.startswith(os.path.abspath(item.path)) for path in pinning)
+        ]
+
+    def _evict(self, item: StorageItem, reason: str) -> None:
+        try:
+            if os.path.isdir(item.path):
+                shutil.rmtree(item.path)
+            else:
+                os.remove(item.path)
+        except FileNotFoundError:
+            return
+
+        self.evicted_files += 1
+        self.evicted_bytes += item.size
+        logger.info(f"Evicted {item.path} ({item.size // MB} MB): {reason}")
+
+    async def sweep(self) -> None:
+        """update the usage and evict the files if the limits are exceeded"""
+        async with self.lock:
+            loop = asyncio.get_running_loop()
+            self.usage = await asyncio.gather(
+                *(loop.run_in_executor(None, _scan, directory) for directory in config.storage.directories)
+            )
+            evictable: tp.List[StorageItem] = []
+
+            for usage in self.usage:
+                try:
+                    items = await self._get_evictable(usage)
+                except Exception as e:
+                    logger.error(f"Cannot tell which files in {usage.path} are published: {e}")
+                    continue
+
+                usage.evictable_bytes = sum(item.size for item in items)
+                evictable.extend(items)
+
+            evictable.sort(key=lambda item: item.last_used)
+            evicted: tp.List[StorageItem] = []
+
+            if config.storage.max_age_days is not None:
+                max_age = config.storage.max_age_days * 24 * 3600
+
+                evicted = [item for item in evictable if time() - item.last_used > max_age]
+
+                for item in evicted:
+                    self._evict(item, f"unused for more than {config.storage.max_age_days} days")
+                    evictable.remove(item)
+
+            quota = config.storage.quota_mb * MB if config.storage.quota_mb is not None else None
+            used = sum(usage.used_bytes for usage in self.usage) - sum(item.size for item in evicted)
+
+            while evictable and (
+                (quota is not None and used > quota) or self.free_bytes < config.storage.min_free_mb * MB
+            ):
+                item = evictable.pop(0)
+                self._evict(item, "running out of space")
+                used -= item.size
+
+            if self.free_bytes < config.storage.min_free_mb * MB:
+                logger.error(
+                    f"Only {self.free_bytes // MB} MB of disk space is left and there is nothing to evict. "
+                    "Publish the recordings or free the disk space."
+                )
+
+            self.last_sweep = datetime.now()
+
+    async def check_free_space(self) -> None:
+        """make sure there is space for a new recording, evicting files if needed"""
+        if self.free_bytes >= config.storage.min_free_mb * MB:
+            return
+
+        await self.sweep()
+        free_bytes = self.free_bytes
+
+        if free_bytes < config.storage.critical_free_mb * MB:
+            raise OSError(f"Not enough disk space: only {free_bytes // MB} MB left")
+
+        if free_bytes < config.storage.min_free_mb * MB:
+            logger.warning(f"Running out of disk space: only {free_bytes // MB} MB left")
+
+    async def run(self, interval: float) -> None:
+        """sweep the directories every interval seconds"""
+        logger.info(f"A daemon was started to manage the disk usage. Update interval is {interval} s.")
+
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Disk usage sweep failed: {e}")
+
+            await asyncio.sleep(interval)
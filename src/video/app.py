@@ -1,24 +1,45 @@
 import asyncio
 import typing as tp
+from datetime import datetime
+from hashlib import sha1
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Header, Query, Request, Response, status
 from loguru import logger
 
-from .camera import Camera, Recording, cameras, records
+from .camera import Camera, Recording, cameras, ingests, monitor_cameras, records
 from .dependencies import get_camera_by_number, get_record_by_id
 from .models import (
     CameraList,
     CameraModel,
+    DirectoryUsageModel,
     GenericResponse,
     RecordData,
     RecordList,
+    RecordResponse,
     StartRecordResponse,
     StopRecordResponse,
+    StorageUsage,
+)
+from .registry import (
+    find_records,
+    get_last_update,
+    is_changed_since,
+    reconcile_records,
+    recover_records,
+    start_record,
+    stop_record,
+    stuck_records,
+    to_entry,
 )
-from .utils import end_stuck_records
 from ..dependencies import authenticate
+from ..models import FINAL_RECORD_STATUSES, RecordEntry, RecordStatus
+from ..shared.config import config
+from ..storage import MB, StorageManager
+
+MAX_RECORDS_PAGE_SIZE = 1000
 
 router = APIRouter()
+background_tasks: tp.Set["asyncio.Task[None]"] = set()
 
 
 @router.post(
@@ -28,16 +49,27 @@ router = APIRouter()
 )
 async def start_recording(
     camera: Camera = Depends(get_camera_by_number),
+    max_duration: tp.Optional[float] = Query(None, gt=0),
 ) -> tp.Union[StartRecordResponse, GenericResponse]:
-    """start recording a video using specified camera"""
-    record = Recording(camera.rtsp_stream_link)
+    """
+    start recording a video using specified camera
+
+    The recording is stopped once it lasts max_duration seconds, which defaults to the camera
+    or the global maximum.
+    """
+    record = Recording(
+        camera.rtsp_stream_link,
+        camera_number=camera.number,
+        ingest=ingests.get(camera.number),
+        pre_roll=camera.pre_roll,
+    )
 
     try:
-        if not camera.is_up():
+        # a camera known to be down is rechecked in case it went back up since the last check
+        if not camera.is_up() and not await camera.check():
             raise BrokenPipeError(f"{camera} is unreachable")
 
-        await record.start()
-        records[record.record_id] = record
+        await start_record(record, max_duration or camera.max_duration or config.video.max_record_duration)
 
         message = f"Started recording video for recording {record.record_id}"
         logger.info(message)
@@ -55,15 +87,26 @@ async def start_recording(
     response_model=tp.Union[StopRecordResponse, GenericResponse],  # type: ignore
 )
 async def end_recording(record: Recording = Depends(get_record_by_id)) -> tp.Union[StopRecordResponse, GenericResponse]:
-    """finish recording a video"""
+    """
+    finish recording a video
+
+    With post-processing enabled the video is not ready yet when this returns, so no filename is given.
+    Get the record to find out when it is done and where the video is.
+    """
     try:
         if not record.is_ongoing:
             raise ValueError("Recording is not currently ongoing thus cannot be stopped")
 
-        await record.stop()
+        await stop_record(record)
         message = f"Stopped recording video for recording {record.record_id}"
         logger.info(message)
-        return StopRecordResponse(status=status.HTTP_200_OK, details=message, filename=record.filename)
+        return StopRecordResponse(
+            status=status.HTTP_200_OK,
+            details=message,
+            record_id=record.record_id,
+            record_status=record.status,
+            filename=record.filename if record.status in FINAL_RECORD_STATUSES else None,
+        )
 
     except Exception as e:
         message = f"Failed to stop recording video for recording {record.record_id}: {e}"
@@ -71,11 +114,41 @@ async def end_recording(record: Recording = Depends(get_record_by_id)) -> tp.Uni
         return GenericResponse(status=status.HTTP_500_INTERNAL_SERVER_ERROR, details=message)
 
 
+def _to_record_data(entry: RecordEntry) -> RecordData:
+    """the video file is only given once the video is ready, as it is moved around while being processed"""
+    return RecordData(
+        filename=entry.filename if entry.status in FINAL_RECORD_STATUSES else None,
+        record_id=entry.record_id,
+        camera_number=entry.camera_number,
+        status=entry.status,
+        start_time=entry.start_time,
+        end_time=entry.end_time,
+        thumbnail=entry.thumbnail,
+        ipfs_cid=entry.ipfs_cid,
+        ipfs_link=entry.ipfs_link,
+    )
+
+
+@router.get("/record/{record_id}", response_model=RecordResponse)
+def get_record_data(record: Recording = Depends(get_record_by_id)) -> RecordResponse:
+    """return the record, its filename is set once the video is ready"""
+    entry = to_entry(record)
+    message = f"Recording {record.record_id} is {entry.status}"
+    return RecordResponse(status=status.HTTP_200_OK, details=message, record=_to_record_data(entry))
+
+
 @router.get("/cameras", response_model=CameraList)
 def get_cameras() -> CameraList:
     """return a list of all connected cameras"""
     cameras_data = [
-        CameraModel(number=camera.number, host=camera.host, is_up=camera.is_up()) for camera in cameras.values()
+        CameraModel(
+            number=camera.number,
+            host=camera.host,
+            is_up=camera.is_up(),
+            last_checked=camera.state.last_checked,
+            last_seen=camera.state.last_seen,
+        )
+        for camera in cameras.values()
     ]
     message = f"Collected {len(cameras_data)} cameras"
     logger.info(message)
@@ -83,45 +156,124 @@ def get_cameras() -> CameraList:
     return CameraList(status=status.HTTP_200_OK, details=message, cameras=cameras_data)
 
 
-@router.get("/records", response_model=RecordList)
-def get_records() -> RecordList:
-    """return a list of all tracked records"""
+@router.get("/records", response_model=tp.Union[RecordList, GenericResponse])  # type: ignore
+async def get_records(
+    request: Request,
+    response: Response,
+    record_status: tp.Optional[RecordStatus] = Query(None, alias="status"),
+    camera: tp.Optional[int] = None,
+    start_from: tp.Optional[datetime] = None,
+    start_to: tp.Optional[datetime] = None,
+    changed_since: tp.Optional[datetime] = None,
+    cursor: tp.Optional[str] = None,
+    limit: int = Query(100, ge=1, le=MAX_RECORDS_PAGE_SIZE),
+    if_none_match: tp.Optional[str] = Header(None),
+) -> tp.Union[RecordList, GenericResponse, Response]:
+    """
+    return a page of the records, latest first, filtered by status, camera and start time
+
+    Use the returned next_cursor to get the next page. Pollers may pass the ETag of the previous
+    response in If-None-Match or the time of the previous poll in changed_since to get a 304
+    response if nothing has changed.
+    """
+    try:
+        last_update = await get_last_update()
+        etag = '"' + sha1(f"{request.url.query}|{last_update}".encode()).hexdigest() + '"'
+
+        if if_none_match == etag or (changed_since is not None and not is_changed_since(last_update, changed_since)):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        entries, next_cursor = await find_records(
+            record_status, camera, start_from, start_to, changed_since, cursor, limit
+        )
+
+    except ValueError as e:
+        message = f"Failed to get records: {e}"
+        logger.error(message)
+        return GenericResponse(status=status.HTTP_400_BAD_REQUEST, details=message)
+
+    except Exception as e:
+        message = f"Failed to get records: {e}"
+        logger.error(message)
+        return GenericResponse(status=status.HTTP_500_INTERNAL_SERVER_ERROR, details=message)
+
     ongoing_records = []
     ended_records = []
 
-    for record in records.values():
-        record_data = RecordData(
-            filename=record.filename,
-            record_id=record.record_id,
-            start_time=record.start_time,
-            end_time=record.end_time,
-        )
+    for entry in entries:
+        record_data = _to_record_data(entry)
 
-        if record.is_ongoing:
+        if entry.status == "recording":
             ongoing_records.append(record_data)
         else:
             ended_records.append(record_data)
 
     message = f"Collected {len(ongoing_records)} ongoing and {len(ended_records)} ended records"
     logger.info(message)
+    response.headers["ETag"] = etag
 
     return RecordList(
-        status=status.HTTP_200_OK, details=message, ongoing_records=ongoing_records, ended_records=ended_records
+        status=status.HTTP_200_OK,
+        details=message,
+        ongoing_records=ongoing_records,
+        ended_records=ended_records,
+        next_cursor=next_cursor,
+    )
+
+
+@router.get("/storage", response_model=StorageUsage)
+def get_storage_usage() -> StorageUsage:
+    """return the disk usage of the video and cache directories as of the last sweep"""
+    manager = StorageManager()
+    directories = [
+        DirectoryUsageModel(
+            path=usage.path,
+            used_bytes=usage.used_bytes,
+            files=usage.files,
+            evictable_bytes=usage.evictable_bytes,
+            free_bytes=usage.free_bytes,
+            total_bytes=usage.total_bytes,
+        )
+        for usage in manager.usage
+    ]
+    message = f"Collected the usage of {len(directories)} directories"
+    logger.info(message)
+
+    return StorageUsage(
+        status=status.HTTP_200_OK,
+        details=message,
+        directories=directories,
+        quota_bytes=int(config.storage.quota_mb * MB) if config.storage.quota_mb is not None else None,
+        evicted_files=manager.evicted_files,
+        evicted_bytes=manager.evicted_bytes,
+        last_sweep=manager.last_sweep,
     )
 
 
 @router.on_event("startup")
 @logger.catch(reraise=True)
-def startup_event() -> None:
+async def startup_event() -> None:
     """tasks to do at server startup"""
-    asyncio.create_task(end_stuck_records())
+    background_tasks.add(asyncio.create_task(stuck_records.run()))
+    background_tasks.add(asyncio.create_task(monitor_cameras(config.video.camera_check_interval)))
+
+    # the orphaned processes are stopped first, the videos they left are joined in the background
+    interrupted = await reconcile_records()
+    background_tasks.add(asyncio.create_task(recover_records(interrupted)))
+
+    for ingest in ingests.values():
+        if ingest.always_on:
+            await ingest.start()
 
 
 @router.on_event("shutdown")
 @logger.catch(reraise=True)
 async def shutdown_event() -> None:
     """tasks to do at server shutdown"""
-    for rec in records.values():
+    for rec in list(records.values()):
         if rec.is_ongoing:
-            await rec.stop()
+            await stop_record(rec)
             logger.warning(f"Recording {rec.record_id} was stopped due to server shutdown.")
+
+    for ingest in ingests.values():
+        await ingest.stop()
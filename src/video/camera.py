@@ -2,17 +2,31 @@ from __future__ import annotations
 
 import asyncio
 import os
-import socket
+import shutil
 import typing as tp
 from dataclasses import dataclass, field
-from datetime import datetime
+from datetime import datetime, timedelta
 from uuid import uuid4
 
 from loguru import logger
 
-from ..shared.config import camera_config
+from .ffmpeg import FfmpegSupervisor, concat_files
+from .ingest import SEGMENT_DURATION_SEC, BufferedSegment, CameraIngest
+from .segments import Segment, read_segment_list, write_playlist
+from ..models import RecordStatus
+from ..shared.config import camera_config, config
 
 MINIMAL_RECORD_DURATION_SEC = 3
+BUFFERED_STOP_TIMEOUT_SEC = 10  # how long to wait for the segment containing the stop time to close
+
+
+@dataclass
+class CameraState:
+    """cached reachability of a camera, kept up to date by the `monitor_cameras` daemon"""
+
+    is_up: tp.Optional[bool] = None  # None until the first check is done
+    last_checked: tp.Optional[datetime] = None
+    last_seen: tp.Optional[datetime] = None
 
 
 @dataclass(frozen=True)
@@ -23,9 +37,10 @@ class Camera:
     port: int
     number: int
     rtsp_stream_link: str
-
-    def __post_init__(self) -> None:
-        self.is_up()
+    buffer_duration: float = 0
+    pre_roll: float = 0
+    max_duration: tp.Optional[float] = None  # recordings are stopped after, the global maximum applies if not set
+    state: CameraState = field(default_factory=CameraState, compare=False, repr=False)
 
     def __str__(self) -> str:
         return f"Camera no.{self.number} host at {self.ip}:{self.port}"
@@ -35,35 +50,66 @@ class Camera:
         return f"{self.ip}:{self.port}"
 
     def is_up(self) -> bool:
-        """check if camera is reachable on the specified port and ip"""
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(0.25)
+        """check if camera was reachable on the specified port and ip at the last check"""
+        return bool(self.state.is_up)
 
+    async def check(self, timeout: float = 0.25) -> bool:
+        """check if camera is reachable on the specified port and ip right now and update its state"""
         try:
-            s.connect((self.ip, int(self.port)))
+            _, writer = await asyncio.wait_for(asyncio.open_connection(self.ip, int(self.port)), timeout)
+            writer.close()
             is_up = True
-            logger.debug(f"{self} is up")
-        except socket.error:
+        except (OSError, asyncio.TimeoutError):
             is_up = False
-            logger.warning(f"{self} is unreachable")
 
-        s.close()
+        if is_up != self.state.is_up:
+            logger.log("DEBUG" if is_up else "WARNING", f"{self} is {'up' if is_up else 'unreachable'}")
+
+        self.state.is_up = is_up
+        self.state.last_checked = datetime.now()
+
+        if is_up:
+            self.state.last_seen = self.state.last_checked
+
         return is_up
 
 
+async def monitor_cameras(interval: float) -> None:
+    """Check reachability of all the cameras concurrently every interval seconds"""
+    logger.info(f"A daemon was started to monitor cameras. Update interval is {interval} s.")
+
+    while True:
+        await asyncio.gather(*(camera.check() for camera in cameras.values()))
+        await asyncio.sleep(interval)
+
+
 @dataclass
 class Recording:
     """a recording object represents one ongoing recording process"""
 
     rtsp_steam: str
+    camera_number: tp.Optional[int] = None
     filename: tp.Optional[str] = None
-    process_ffmpeg: tp.Optional[asyncio.subprocess.Process] = None
+    status: tp.Union[tp.Literal["pending"], RecordStatus] = "pending"
+    ffmpeg: tp.Optional[FfmpegSupervisor] = field(default=None, repr=False)
     record_id: str = field(default_factory=lambda: uuid4().hex)
     start_time: tp.Optional[datetime] = None
     end_time: tp.Optional[datetime] = None
+    parts: tp.List[str] = field(default_factory=list)  # files written by every ffmpeg run
+    playlist: tp.Optional[str] = None  # HLS playlist of the segments in the segmented mode
+    thumbnail: tp.Optional[str] = None
+    ipfs_cid: tp.Optional[str] = None  # set once the video is published by the post-processing
+    ipfs_link: tp.Optional[str] = None
+    segments_dir: str = field(init=False, repr=False)  # where the segments are written to if segmented
+    ingest: tp.Optional[CameraIngest] = field(default=None, repr=False)  # the camera buffer to cut the video from
+    pre_roll: float = 0  # seconds of the buffer before the start to include
+    buffered: tp.List[BufferedSegment] = field(default_factory=list, init=False, repr=False)
+    _copies: tp.List[asyncio.Future[None]] = field(default_factory=list, init=False, repr=False)
+    _stop_segment_closed: asyncio.Event = field(default_factory=asyncio.Event, init=False, repr=False)
 
     def __post_init__(self) -> None:
         self.filename = self._get_video_filename()
+        self.segments_dir = os.path.splitext(self.filename)[0]
 
     def __len__(self) -> int:
         """calculate recording duration in seconds"""
@@ -87,30 +133,135 @@ class Recording:
     def is_ongoing(self) -> bool:
         return self.start_time is not None and self.end_time is None
 
-    @logger.catch(reraise=True)
-    async def start(self) -> None:
-        """Execute ffmpeg command"""
+    def _get_segmenter_command(self, run: int) -> tp.List[str]:
+        """get the ffmpeg command writing the stream into a series of short MPEG-TS segments"""
+        list_file = f"{self.segments_dir}/run{run:03d}.csv"
+        self.parts.append(list_file)
+        return [
+            "ffmpeg",
+            *("-loglevel", "warning", "-nostats", "-progress", "pipe:1"),
+            *("-rtsp_transport", "tcp", "-i", self.rtsp_steam),
+            *("-r", "25", "-c", "copy", "-map", "0"),
+            *("-f", "segment", "-segment_time", str(config.video.segment_duration), "-segment_format", "mpegts"),
+            *("-segment_list", list_file, "-segment_list_type", "csv"),
+            f"{self.segments_dir}/run{run:03d}_%05d.ts",
+        ]
+
+    def _get_ffmpeg_command(self, run: int) -> tp.List[str]:
+        """get the ffmpeg command writing the stream into a new part file for every run"""
+        if config.video.segmented:
+            return self._get_segmenter_command(run)
+
         # ffmpeg -loglevel warning -rtsp_transport tcp -i "rtsp://login:password@ip:port/Streaming/Channels/101" -c copy -map 0 vid.mp4
-        command: str = (
-            f'ffmpeg -loglevel warning -rtsp_transport tcp -i "{self.rtsp_steam}" -r 25 -c copy -map 0 {self.filename}'
-        )
-        self.process_ffmpeg = await asyncio.subprocess.create_subprocess_shell(
-            cmd=command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            stdin=asyncio.subprocess.PIPE,
-        )
-        self.start_time = datetime.now()
-        logger.info(f"Started recording video '{self.filename}' using ffmpeg. {self.process_ffmpeg.pid=}")
+        assert self.filename is not None
+        part = f"{os.path.splitext(self.filename)[0]}.part{run:03d}.mp4"
+        self.parts.append(part)
+        return [
+            "ffmpeg",
+            *("-loglevel", "warning", "-nostats", "-progress", "pipe:1"),
+            *("-rtsp_transport", "tcp", "-i", self.rtsp_steam),
+            *("-r", "25", "-c", "copy", "-map", "0", "-y", part),
+        ]
+
+    async def _join_parts(self) -> None:
+        """join the files written by every ffmpeg run into the final video"""
+        assert self.filename is not None
+        parts = [part for part in self.parts if os.path.exists(part) and os.path.getsize(part) > 0]
+
+        if not parts:
+            logger.error(f"Recording {self.record_id} produced no video")
+        elif len(parts) == 1:
+            os.replace(parts[0], self.filename)
+        else:
+            logger.info(f"Joining {len(parts)} parts of recording {self.record_id}")
+            await concat_files(parts, self.filename)
+
+        for part in self.parts:
+            if os.path.exists(part):
+                os.remove(part)
+
+        self.parts.clear()
+
+    def _write_playlist(self, runs: tp.List[tp.List[Segment]]) -> tp.List[str]:
+        """write the HLS playlist of the recorded segments and get the segment files"""
+        self.playlist = f"{self.segments_dir}/playlist.m3u8"
+        write_playlist(self.playlist, runs)
+        return [path for segments in runs for path, _ in segments]
 
     @logger.catch(reraise=True)
-    async def stop(self) -> None:
-        """stop recording a video"""
-        if self.process_ffmpeg is None:
-            logger.error(f"Failed to stop record {self.record_id}")
-            logger.debug(f"Operation ongoing: {self.is_ongoing}, ffmpeg process: {bool(self.process_ffmpeg)}")
+    async def _join_segments(self, segments: tp.List[str]) -> None:
+        """join the segments into the final mp4 video and remove them"""
+        assert self.filename is not None
+
+        if not segments:
+            logger.error(f"Recording {self.record_id} produced no video")
             return
 
+        logger.info(f"Joining {len(segments)} segments of recording {self.record_id}")
+        await concat_files(segments, self.filename, "-bsf:a", "aac_adtstoasc")
+        shutil.rmtree(self.segments_dir)
+        self.playlist = None
+        logger.info(f"Recording {self.record_id} is saved to {self.filename}")
+
+    async def _finish_segments(self, runs: tp.List[tp.List[Segment]]) -> None:
+        """expose the closed segments as an HLS playlist or join them into an mp4 video"""
+        segments = self._write_playlist(runs)
+
+        if config.video.segment_output == "hls":
+            self.filename = self.playlist
+        else:
+            await self._join_segments(segments)
+
+    def _take_segment(self, segment: BufferedSegment) -> None:
+        """copy a segment of the camera buffer into the recording"""
+        if self._stop_segment_closed.is_set():
+            return  # the video is complete, the unsubscription is underway
+
+        destination = os.path.join(self.segments_dir, os.path.basename(segment.path))
+        self.buffered.append(
+            BufferedSegment(destination, segment.run, segment.index, segment.duration, segment.end_time)
+        )
+        self._copies.append(asyncio.get_running_loop().run_in_executor(None, _link_or_copy, segment.path, destination))
+
+        if self.end_time is not None and segment.end_time >= self.end_time:
+            self._stop_segment_closed.set()
+
+    async def _start_buffered(self) -> None:
+        """start cutting the video from the camera buffer, beginning with the pre-roll"""
+        assert self.ingest is not None
+        os.makedirs(self.segments_dir, exist_ok=True)
+        self.start_time = datetime.now()
+
+        since = self.start_time - timedelta(seconds=self.pre_roll)
+
+        for segment in await self.ingest.subscribe(self._take_segment, since):
+            self._take_segment(segment)
+
+        self.status = "recording"
+        logger.info(f"Started recording video '{self.filename}' from the {self.ingest.name} capture")
+
+    async def _stop_buffered(self) -> None:
+        """wait for the segment containing the stop time to close and leave the camera capture"""
+        assert self.ingest is not None
+        self.end_time = datetime.now()
+
+        if any(segment.end_time >= self.end_time for segment in self.buffered):
+            self._stop_segment_closed.set()
+
+        try:
+            await asyncio.wait_for(self._stop_segment_closed.wait(), BUFFERED_STOP_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.ingest.name} closed no segments in {BUFFERED_STOP_TIMEOUT_SEC} s")
+            self._stop_segment_closed.set()
+
+        await asyncio.gather(*self._copies)  # before unsubscribing, as the last one out removes the capture files
+        self._copies.clear()
+        await self.ingest.unsubscribe(self._take_segment)
+
+    async def _stop_ffmpeg(self) -> None:
+        """have the recording ffmpeg finalize its output and exit"""
+        assert self.ffmpeg is not None
+
         if len(self) < MINIMAL_RECORD_DURATION_SEC:
             logger.warning(
                 f"Recording {self.record_id} duration is below allowed minimum ({MINIMAL_RECORD_DURATION_SEC=}s). "
@@ -118,23 +269,92 @@ class Recording:
             )
             await asyncio.sleep(MINIMAL_RECORD_DURATION_SEC - len(self))
 
-        logger.info(f"Trying to stop record {self.record_id} process {self.process_ffmpeg.pid=}")
+        logger.info(f"Trying to stop record {self.record_id} process {self.ffmpeg.pid=}")
+        await self.ffmpeg.stop()
+
+        if self.ffmpeg.restarts:
+            logger.warning(f"ffmpeg was restarted {self.ffmpeg.restarts} times during recording {self.record_id}")
 
-        stdout, stderr = await self.process_ffmpeg.communicate(input=b"q")
-        await self.process_ffmpeg.wait()
-        return_code = self.process_ffmpeg.returncode
+        self.ffmpeg = None
+        self.end_time = datetime.now()
+
+    @logger.catch(reraise=True)
+    async def start(self) -> None:
+        """Execute ffmpeg command under supervision"""
+        if self.ingest is not None:
+            await self._start_buffered()
+            return
 
-        if return_code == 0:
-            logger.debug("Got a zero return code from ffmpeg subprocess. Assuming success.")
+        if config.video.segmented:
+            os.makedirs(self.segments_dir, exist_ok=True)
+
+        self.ffmpeg = FfmpegSupervisor(f"Recording {self.record_id}", self._get_ffmpeg_command)
+        await self.ffmpeg.start()
+        self.start_time = datetime.now()
+        self.status = "recording"
+        logger.info(f"Started recording video '{self.filename}' using ffmpeg. {self.ffmpeg.pid=}")
+
+    @logger.catch(reraise=True)
+    async def stop(self, finish: bool = True) -> None:
+        """stop recording a video, the joining of the final video may be left to the caller"""
+        if self.ingest is not None and self.is_ongoing:
+            await self._stop_buffered()
+        elif self.ffmpeg is not None:
+            await self._stop_ffmpeg()
         else:
-            logger.error(f"Got a non zero return code from ffmpeg subprocess: {return_code}")
-            logger.debug(f"{stdout=} {stderr=}")
+            logger.error(f"Failed to stop record {self.record_id}")
+            logger.debug(f"Operation ongoing: {self.is_ongoing}, ffmpeg process: {bool(self.ffmpeg)}")
+            return
 
-        self.process_ffmpeg = None
-        self.end_time = datetime.now()
+        if finish:
+            await self.finish()
+            self.status = "finished"
 
         logger.info(f"Finished recording video for record {self.record_id}")
 
+    async def finish(self) -> None:
+        """join what has been captured into the final video"""
+        if self.ingest is not None:
+            runs: tp.Dict[int, tp.List[Segment]] = {}
+
+            for segment in self.buffered:
+                runs.setdefault(segment.run, []).append((segment.path, segment.duration))
+
+            await self._finish_segments(list(runs.values()))
+        elif config.video.segmented:
+            await self._finish_segments(
+                [read_segment_list(list_file, config.video.segment_duration) for list_file in self.parts]
+            )
+        else:
+            await self._join_parts()
+
+    @logger.catch(reraise=True)
+    async def recover(self) -> None:
+        """finish the video from the files left behind by a recording interrupted by a crash"""
+        if os.path.isdir(self.segments_dir):
+            # the segments copied from a camera capture have no lists, their durations are estimated
+            names = os.listdir(self.segments_dir)
+
+            if self.camera_number is not None:
+                used_ingest = self.camera_number in ingests
+            else:  # unknown if the recording was never saved, only the segmenter writes the lists
+                used_ingest = not any(name.endswith(".csv") for name in names)
+
+            default_duration = SEGMENT_DURATION_SEC if used_ingest else config.video.segment_duration
+            run_names = sorted({name.split("_")[0] for name in names if name.endswith(".ts")})
+            runs = [read_segment_list(f"{self.segments_dir}/{run}.csv", default_duration) for run in run_names]
+            await self._finish_segments(runs)
+        else:
+            directory, name = os.path.split(self.segments_dir)
+            self.parts = sorted(
+                os.path.join(directory, part) for part in os.listdir(directory) if part.startswith(f"{name}.part")
+            )
+            await self._join_parts()
+
+        self.end_time = self.end_time or datetime.now()
+        self.status = "interrupted"
+        logger.info(f"Recovered interrupted recording {self.record_id} into {self.filename}")
+
 
 cameras: tp.Dict[int, Camera] = {
     section.number: Camera(
@@ -142,10 +362,33 @@ cameras: tp.Dict[int, Camera] = {
         port=section.port,
         number=section.number,
         rtsp_stream_link=section.rtsp_stream_link,
+        buffer_duration=section.buffer_duration,
+        pre_roll=section.pre_roll,
+        max_duration=section.max_duration,
     )
     for section in camera_config
 }
 
+# captures shared by the recordings from a camera, always-on ones are needed for the cameras with a buffer
+ingests: tp.Dict[int, CameraIngest] = {
+    camera.number: CameraIngest(
+        name=f"Camera no.{camera.number}",
+        rtsp_stream=camera.rtsp_stream_link,
+        directory=f"{config.video.buffer_dir}/camera{camera.number}",
+        buffer_duration=camera.buffer_duration,
+    )
+    for camera in cameras.values()
+    if config.video.share_ingest or camera.buffer_duration > 0
+}
+
 logger.info(f"Initialized {len(cameras)} cameras")
 
 records: tp.Dict[str, Recording] = {}
+
+
+def _link_or_copy(source: str, destination: str) -> None:
+    """hard link the file if it is on the same filesystem, copy it otherwise"""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
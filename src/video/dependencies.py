@@ -1,6 +1,7 @@
 from fastapi import HTTPException, status
 
-from .camera import Camera, Recording, cameras, records
+from .camera import Camera, Recording, cameras
+from .registry import get_record
 
 
 def get_camera_by_number(camera_number: int) -> Camera:
@@ -11,9 +12,11 @@ def get_camera_by_number(camera_number: int) -> Camera:
     raise HTTPException(status.HTTP_404_NOT_FOUND, f"No such camera: {camera_number}")
 
 
-def get_record_by_id(record_id: str) -> Recording:
+async def get_record_by_id(record_id: str) -> Recording:
     """get a record by its uuid"""
-    if record_id in records:
-        return records[record_id]
+    record = await get_record(record_id)
+
+    if record is not None:
+        return record
 
     raise HTTPException(status.HTTP_404_NOT_FOUND, f"No such recording: {record_id}")
@@ -0,0 +1,213 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import signal
+import typing as tp
+from time import monotonic
+
+from loguru import logger
+
+# ffmpeg runs shorter than that are considered failed to start and are restarted with a growing delay
+STABLE_RUN_SEC: float = 30
+MIN_RESTART_DELAY_SEC: float = 1
+MAX_RESTART_DELAY_SEC: float = 10
+
+
+class FfmpegSupervisor:
+    """
+    Runs an ffmpeg command and watches over it until stopped.
+
+    The process progress and warnings are streamed into the supervisor and the logs. Whenever ffmpeg exits
+    before it was asked to, e.g. because the RTSP stream dropped, it is started again. The command is built
+    by `get_command` for every run, so that each run can write into a separate output.
+    """
+
+    def __init__(self, name: str, get_command: tp.Callable[[int], tp.List[str]]) -> None:
+        self.name = name
+        self.progress: tp.Dict[str, str] = {}
+        self.restarts: int = 0
+        self._get_command = get_command
+        self._process: tp.Optional[asyncio.subprocess.Process] = None
+        self._task: tp.Optional[asyncio.Task[None]] = None
+        self._stopping = asyncio.Event()
+
+    @property
+    def pid(self) -> tp.Optional[int]:
+        return self._process.pid if self._process is not None else None
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _spawn(self) -> asyncio.subprocess.Process:
+        command = self._get_command(self.restarts)
+        logger.debug(f"{self.name}: running {' '.join(command)}")
+        return await asyncio.subprocess.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.PIPE,
+        )
+
+    async def _read_progress(self, stdout: asyncio.StreamReader) -> None:
+        """parse the key=value blocks ffmpeg writes with the `-progress pipe:1` option"""
+        async for line in stdout:
+            key, _, value = line.decode(errors="replace").strip().partition("=")
+
+            if key:
+                self.progress[key] = value
+
+    async def _read_log(self, stderr: asyncio.StreamReader) -> None:
+        async for line in stderr:
+            logger.warning(f"{self.name}: ffmpeg: {line.decode(errors='replace').rstrip()}")
+
+    async def _supervise(self) -> None:
+        delay = MIN_RESTART_DELAY_SEC
+
+        while self._process is not None:
+            process = self._process
+            started_at = monotonic()
+            assert process.stdout is not None and process.stderr is not None
+            await asyncio.gather(self._read_progress(process.stdout), self._read_log(process.stderr))
+            return_code = await process.wait()
+
+            if self._stopping.is_set():
+                logger.debug(f"{self.name}: ffmpeg exited with code {return_code}")
+                return
+
+            if monotonic() - started_at > STABLE_RUN_SEC:
+                delay = MIN_RESTART_DELAY_SEC
+
+            logger.error(f"{self.name}: ffmpeg exited unexpectedly with code {return_code}. Restarting in {delay} s.")
+
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=delay)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+            delay = min(delay * 2, MAX_RESTART_DELAY_SEC)
+            self.restarts += 1
+            self._process = await self._spawn()
+
+            if self._stopping.is_set():  # stop was called while the process was being spawned
+                await self._ask_to_quit(self._process)
+
+    async def start(self) -> None:
+        """start ffmpeg and the supervisor task"""
+        self._process = await self._spawn()
+        self._task = asyncio.create_task(self._supervise())
+
+    @staticmethod
+    async def _ask_to_quit(process: asyncio.subprocess.Process) -> None:
+        if process.returncode is None and process.stdin is not None:
+            try:
+                process.stdin.write(b"q")
+                await process.stdin.drain()
+            except ConnectionError:
+                pass  # ffmpeg has already exited
+
+    async def stop(self, timeout: float = 30) -> None:
+        """ask ffmpeg to finish writing and exit, kill it if it does not in time"""
+        self._stopping.set()
+
+        if self._process is not None:
+            await self._ask_to_quit(self._process)
+
+        if self._task is None:
+            return
+
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"{self.name}: ffmpeg did not exit in {timeout} s. Killing it.")
+
+            # the supervisor may have restarted ffmpeg meanwhile, so the current process is killed
+            if self._process is not None and self._process.returncode is None:
+                self._process.kill()
+
+            await self._task
+
+
+async def run_ffmpeg(*args: str) -> None:
+    """run a one-off ffmpeg command to completion"""
+    process = await asyncio.subprocess.create_subprocess_exec(
+        "ffmpeg",
+        "-loglevel",
+        "error",
+        "-y",
+        *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await process.communicate()
+
+    if process.returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {process.returncode}: {stderr.decode(errors='replace')}")
+
+
+async def concat_files(inputs: tp.List[str], output: str, *args: str) -> None:
+    """losslessly join several videos of the same stream into one, extra output options may be provided"""
+    list_file = f"{output}.concat.txt"
+
+    with open(list_file, "w") as f:
+        f.writelines(f"file '{os.path.abspath(input_)}'\n" for input_ in inputs)
+
+    try:
+        await run_ffmpeg("-f", "concat", "-safe", "0", "-i", list_file, "-c", "copy", "-map", "0", *args, output)
+    finally:
+        os.remove(list_file)
+
+
+def find_ffmpeg_processes(marker: str) -> tp.List[int]:
+    """get the pids of the running ffmpeg processes with the marker in their command line (Linux only)"""
+    if not os.path.isdir("/proc"):
+        return []
+
+    pids = []
+
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+
+        try:
+            with open(f"/proc/{entry.name}/cmdline", "rb") as f:
+                args = f.read().split(b"\0")
+        except OSError:
+            continue  # the process has exited meanwhile
+
+        if os.path.basename(args[0]) == b"ffmpeg" and any(marker.encode() in arg for arg in args):
+            pids.append(int(entry.name))
+
+    return pids
+
+
+async def terminate_process(pid: int, timeout: float = 10) -> None:
+    """ask a process which is not our child to exit, kill it if it does not in time"""
+    # ffmpeg finalizes the output on SIGTERM, just like on "q"
+    for sig, wait in ((signal.SIGTERM, timeout), (signal.SIGKILL, 1.0)):
+        try:
+            os.kill(pid, sig)
+        except ProcessLookupError:
+            return
+
+        deadline = monotonic() + wait
+
+        while monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+            if not _is_alive(pid):
+                return
+
+    logger.error(f"Failed to terminate process {pid}")
+
+
+def _is_alive(pid: int) -> bool:
+    """check if the process exists and is not a zombie"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            return f.read().rpartition(")")[2].split()[0] != "Z"
+    except OSError:
+        return False
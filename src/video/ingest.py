@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import asyncio
+import csv
+import os
+import re
+import shutil
+import typing as tp
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+from loguru import logger
+
+from .ffmpeg import FfmpegSupervisor
+
+SEGMENT_DURATION_SEC = 1  # the recordings are cut from the buffer with this granularity
+POLL_INTERVAL_SEC = 0.2  # how often the segment list is checked for newly closed segments
+SEGMENT_LIST_SIZE = 10
+MIN_BUFFER_DURATION_SEC = 5  # segments are kept at least that long so that the sinks have the time to copy them
+SEGMENT_NAME_PATTERN = re.compile(r"run(\d+)_(\d+)\.ts$")
+
+
+@dataclass(frozen=True)
+class BufferedSegment:
+    """a closed segment of the stream in the buffer"""
+
+    path: str
+    run: int  # the ffmpeg run the segment was written by, runs are discontinuous
+    index: int
+    duration: float
+    end_time: datetime
+
+    @property
+    def start_time(self) -> datetime:
+        return self.end_time - timedelta(seconds=self.duration)
+
+
+SegmentSink = tp.Callable[[BufferedSegment], None]
+
+
+class CameraIngest:
+    """
+    A single capture of a camera RTSP stream shared by all the recordings from the camera.
+
+    ffmpeg cuts the stream into short MPEG-TS segments in the buffer directory (a tmpfs preferably)
+    and every newly closed segment is handed to the subscribed sinks, so the camera serves one
+    session however many recordings are ongoing. The capture is started by the first subscriber and
+    stopped once the last one leaves, unless a `buffer_duration` is set. In that case it is always on
+    and the segments of the last `buffer_duration` seconds are kept, so recordings start without
+    waiting for ffmpeg and may include the seconds before their start.
+    """
+
+    def __init__(self, name: str, rtsp_stream: str, directory: str, buffer_duration: float) -> None:
+        self.name = name
+        self.rtsp_stream = rtsp_stream
+        self.directory = directory
+        self.buffer_duration = buffer_duration
+        self.segments: tp.Deque[BufferedSegment] = deque()
+        self._sinks: tp.List[SegmentSink] = []
+        self._list_files: tp.List[str] = []
+        self._last_seen: tp.Tuple[int, int] = (-1, -1)
+        self._ffmpeg: tp.Optional[FfmpegSupervisor] = None
+        self._watcher: tp.Optional[asyncio.Task[None]] = None
+        self._lock: tp.Optional[asyncio.Lock] = None
+
+    @property
+    def always_on(self) -> bool:
+        return self.buffer_duration > 0
+
+    @property
+    def is_running(self) -> bool:
+        return self._ffmpeg is not None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        """serializes starting and stopping, created lazily to be bound to the running loop"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        return self._lock
+
+    def _get_ffmpeg_command(self, run: int) -> tp.List[str]:
+        list_file = f"{self.directory}/run{run:03d}.csv"
+        self._list_files.append(list_file)
+        return [
+            "ffmpeg",
+            *("-loglevel", "warning", "-nostats", "-progress", "pipe:1"),
+            *("-rtsp_transport", "tcp", "-i", self.rtsp_stream),
+            *("-r", "25", "-c", "copy", "-map", "0"),
+            *("-f", "segment", "-segment_time", str(SEGMENT_DURATION_SEC), "-segment_format", "mpegts"),
+            *("-segment_list", list_file, "-segment_list_type", "csv", "-segment_list_size", str(SEGMENT_LIST_SIZE)),
+            f"{self.directory}/run{run:03d}_%08d.ts",
+        ]
+
+    def _read_new_segments(self, list_file: str) -> tp.List[BufferedSegment]:
+        """get the segments closed since the last check from the segment list of an ffmpeg run"""
+        if not os.path.exists(list_file):
+            return []
+
+        with open(list_file, newline="") as f:
+            rows = [row for row in csv.reader(f) if len(row) >= 3]
+
+        now = datetime.now()
+        new_segments = []
+
+        for name, start, end, *_ in rows:
+            match = SEGMENT_NAME_PATTERN.search(name)
+
+            if match is None:
+                continue
+
+            key = (int(match.group(1)), int(match.group(2)))
+
+            if key > self._last_seen:
+                self._last_seen = key
+                path = os.path.join(self.directory, name)
+                new_segments.append(BufferedSegment(path, key[0], key[1], float(end) - float(start), now))
+
+        return new_segments
+
+    def _evict(self) -> None:
+        """drop the segments that do not fit into the buffer duration anymore"""
+        buffer_duration = timedelta(seconds=max(self.buffer_duration, MIN_BUFFER_DURATION_SEC))
+
+        while len(self.segments) > 1 and self.segments[-1].end_time - self.segments[1].start_time > buffer_duration:
+            segment = self.segments.popleft()
+
+            try:
+                os.remove(segment.path)
+            except FileNotFoundError:
+                pass
+
+    async def _watch(self) -> None:
+        """pick up the newly closed segments and hand them to the sinks"""
+        while True:
+            for list_file in self._list_files[-2:]:  # the previous run may have closed its last segment on exit
+                for segment in self._read_new_segments(list_file):
+                    self.segments.append(segment)
+
+                    for sink in list(self._sinks):
+                        sink(segment)
+
+            self._evict()
+            await asyncio.sleep(POLL_INTERVAL_SEC)
+
+    async def subscribe(self, sink: SegmentSink, since: datetime) -> tp.List[BufferedSegment]:
+        """
+        Start handing newly closed segments to the sink, starting the capture if it is not running.
+
+        The buffered segments ending after `since` are returned, so that the sink gets a continuous
+        stream starting at that time, provided it is still in the buffer.
+        """
+        async with self.lock:
+            if not self.is_running:
+                await self._start()
+
+            self._sinks.append(sink)
+            logger.debug(f"{self.name}: {len(self._sinks)} subscribers")
+            return [segment for segment in self.segments if segment.end_time > since]
+
+    async def unsubscribe(self, sink: SegmentSink) -> None:
+        """stop handing segments to the sink, stop the capture if nobody needs it anymore"""
+        async with self.lock:
+            self._sinks.remove(sink)
+            logger.debug(f"{self.name}: {len(self._sinks)} subscribers")
+
+            if not self._sinks and not self.always_on and self.is_running:
+                await self._stop()
+
+    async def start(self) -> None:
+        """start capturing the stream"""
+        async with self.lock:
+            if not self.is_running:
+                await self._start()
+
+    async def stop(self) -> None:
+        """stop capturing the stream and drop the buffer"""
+        async with self.lock:
+            if self.is_running:
+                await self._stop()
+
+    async def _start(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+        self._ffmpeg = FfmpegSupervisor(self.name, self._get_ffmpeg_command)
+        await self._ffmpeg.start()
+        self._watcher = asyncio.create_task(self._watch())
+        logger.info(f"{self.name}: capturing the stream into {self.directory}")
+
+    async def _stop(self) -> None:
+        if self._ffmpeg is not None:
+            await self._ffmpeg.stop()
+            self._ffmpeg = None
+
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+        self.segments.clear()
+        self._list_files.clear()
+        self._last_seen = (-1, -1)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        logger.info(f"{self.name}: stopped buffering the stream")
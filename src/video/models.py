@@ -14,26 +14,57 @@ class StartRecordResponse(GenericResponse):
 
 
 class StopRecordResponse(GenericResponse):
-    filename: str
+    record_id: str
+    record_status: str
+    filename: tp.Optional[str] = None  # not set while the video is being processed, get the record once it is done
 
 
 class RecordData(BaseModel):
     filename: tp.Optional[str]
     record_id: str
+    camera_number: tp.Optional[int] = None
+    status: tp.Optional[str] = None
     start_time: tp.Optional[datetime]
     end_time: tp.Optional[datetime]
+    thumbnail: tp.Optional[str] = None
+    ipfs_cid: tp.Optional[str] = None
+    ipfs_link: tp.Optional[str] = None
+
+
+class RecordResponse(GenericResponse):
+    record: RecordData
 
 
 class RecordList(GenericResponse):
     ongoing_records: tp.List[RecordData]
     ended_records: tp.List[RecordData]
+    next_cursor: tp.Optional[str] = None  # pass as the cursor parameter to get the next page
 
 
 class CameraModel(BaseModel):
     number: int
     host: str
     is_up: bool
+    last_checked: tp.Optional[datetime]
+    last_seen: tp.Optional[datetime]
 
 
 class CameraList(GenericResponse):
     cameras: tp.List[CameraModel]
+
+
+class DirectoryUsageModel(BaseModel):
+    path: str
+    used_bytes: int
+    files: int
+    evictable_bytes: int  # taken by the published recordings and cached files
+    free_bytes: int
+    total_bytes: int
+
+
+class StorageUsage(GenericResponse):
+    directories: tp.List[DirectoryUsageModel]
+    quota_bytes: tp.Optional[int]
+    evicted_files: int  # since the server start
+    evicted_bytes: int
+    last_sweep: tp.Optional[datetime]
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import shutil
+import typing as tp
+from pathlib import Path
+
+from loguru import logger
+
+from .camera import Recording
+from .ffmpeg import run_ffmpeg
+from ..io_gateway.app import publish_directory, publish_file
+from ..io_gateway.pin_queue import PinQueue
+from ..models import RecordStatus
+from ..shared.config import config
+
+THUMBNAIL_AT_SEC = 1.0
+THUMBNAIL_WIDTH = 320
+# the order of the post-processing stages, a resumed recording skips the ones it has passed
+STAGE_ORDER: tp.Dict[str, int] = {"joining": 0, "remuxing": 1, "transcoding": 1, "thumbnailing": 2, "publishing": 3}
+
+
+async def _remux_faststart(filename: str, output: str) -> None:
+    """move the moov atom to the beginning of the file, so that the video can be played while downloading"""
+    await run_ffmpeg("-i", filename, "-c", "copy", "-map", "0", "-movflags", "+faststart", output)
+
+
+async def _transcode(filename: str, output: str, height: int) -> None:
+    """downscale the video to the height and re-encode it, streamable as well"""
+    await run_ffmpeg(
+        *("-i", filename, "-vf", f"scale=-2:'min({height},ih)'"),
+        *("-c:v", "libx264", "-preset", config.video.transcode_preset, "-crf", str(config.video.transcode_crf)),
+        *("-c:a", "copy", "-movflags", "+faststart", output),
+    )
+
+
+async def _extract_thumbnail(record: Recording) -> str:
+    """save a frame from the beginning of the video next to it (outside of the segments directory)"""
+    assert record.filename is not None
+    thumbnail = f"{record.segments_dir}.jpg"
+    position = min(THUMBNAIL_AT_SEC, len(record) / 2)
+    await run_ffmpeg(
+        *("-ss", str(position), "-i", record.filename),
+        *("-frames:v", "1", "-vf", f"scale={THUMBNAIL_WIDTH}:-2", thumbnail),
+    )
+    return thumbnail
+
+
+class PostProcessor:
+    """
+    Processes the stopped recordings in the background.
+
+    The video is joined, remuxed for streaming or transcoded and a thumbnail is extracted from it, then the
+    video is published and the local copy is deleted if enabled by config. The ffmpeg stages of at most
+    `workers` recordings run at the same time, the rest wait in the queue. The recording status reflects
+    the current stage and is saved with the `save` callback on every change.
+    """
+
+    def __init__(self, workers: int, save: tp.Callable[[Recording], tp.Awaitable[None]]) -> None:
+        self._workers = workers
+        self._save = save
+        self._slots: tp.Optional[asyncio.Semaphore] = None
+        self._tasks: tp.Set[asyncio.Task[None]] = set()
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        """created lazily to be bound to the running loop"""
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._workers)
+
+        return self._slots
+
+    def submit(self, record: Recording, join: bool = True) -> None:
+        """
+        schedule processing of the stopped recording, the joining may be skipped if it is done already.
+        A recording saved at a post-processing stage is resumed from that stage
+        """
+        resume_at = STAGE_ORDER.get(record.status, 0)
+        record.status = "queued"
+        task = asyncio.create_task(self._process(record, join, resume_at))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _set_stage(self, record: Recording, stage: RecordStatus, output: tp.Optional[str] = None) -> None:
+        """
+        move the recording to the stage along with the video the previous stage wrote to a new file, if any.
+        The previous video is kept until the switch is saved, so an interrupted stage is redone from its input
+        """
+        previous, record.status = record.filename, stage
+
+        if output is not None:
+            record.filename = output
+
+        logger.info(f"Recording {record.record_id} is {stage}")
+        await self._save(record)
+
+        if output is not None and previous is not None and previous != output:
+            os.remove(previous)
+
+    async def _process(self, record: Recording, join: bool, resume_at: int = 0) -> None:
+        def is_due(stage: RecordStatus) -> bool:
+            return STAGE_ORDER[stage] >= resume_at
+
+        try:
+            await self._save(record)
+            output: tp.Optional[str] = None
+
+            async with self.slots:
+                if join:
+                    await self._set_stage(record, "joining")
+                    await record.finish()
+
+                assert record.filename is not None
+                # an mp4 resumed past the remuxing or transcoding is already the output of that stage
+                needs_encoding = record.filename.endswith(".mp4") and is_due("transcoding")
+
+                if needs_encoding and config.video.transcode_height:
+                    await self._set_stage(record, "transcoding")
+                    output = f"{record.segments_dir}.transcoded.mp4"
+                    await _transcode(record.filename, output, config.video.transcode_height)
+                elif needs_encoding and config.video.faststart:
+                    await self._set_stage(record, "remuxing")
+                    output = f"{record.segments_dir}.faststart.mp4"
+                    await _remux_faststart(record.filename, output)
+
+                if config.video.thumbnail and is_due("thumbnailing"):
+                    await self._set_stage(record, "thumbnailing", output)
+                    output = None
+                    record.thumbnail = await _extract_thumbnail(record)
+
+            if config.video.auto_publish:
+                await self._set_stage(record, "publishing", output)
+                output = None
+                await self._publish(record)
+
+            await self._set_stage(record, "finished", output)
+
+        except Exception as e:
+            logger.error(f"Post-processing of recording {record.record_id} failed at the {record.status} stage: {e}")
+            record.status = "failed"
+            await self._save(record)
+
+    async def _publish(self, record: Recording) -> None:
+        """publish the video and delete the local copy once it is no longer needed if enabled by config"""
+        assert record.filename is not None
+
+        if record.filename.endswith(".m3u8"):  # an HLS playlist is published along with its segments
+            path = Path(record.filename).parent
+            record.ipfs_cid, record.ipfs_link, results = await publish_directory(path)
+            cids = [result.ipfs_cid for result in results if result.ipfs_cid is not None]
+        else:
+            path = Path(record.filename)
+            record.ipfs_cid, record.ipfs_link = await publish_file(path)
+            cids = [record.ipfs_cid]
+
+        logger.info(f"Recording {record.record_id} is published as {record.ipfs_cid}")
+
+        if not config.video.delete_after_publishing:
+            return
+
+        if config.ipfs.enable and config.pinata.enable:  # the files are pinned to Pinata from the disk later
+            try:
+                jobs = await asyncio.gather(*(PinQueue().wait(cid) for cid in cids))
+            except ValueError as e:
+                logger.warning(f"Cannot tell if recording {record.record_id} is pinned, keeping the local copy: {e}")
+                return
+
+            if any(job.status != "done" for job in jobs):
+                logger.warning(f"Recording {record.record_id} was not pinned to Pinata, keeping the local copy")
+                return
+
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+        logger.info(f"Deleted the local copy of recording {record.record_id}")
@@ -0,0 +1,242 @@
+import os
+import re
+import typing as tp
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from loguru import logger
+
+from .camera import Recording, ingests, records
+from .ffmpeg import find_ffmpeg_processes, terminate_process
+from .pipeline import PostProcessor
+from .utils import DeadlineScheduler
+from ..database import MongoDbWrapper
+from ..models import RecordEntry
+from ..shared.config import config
+from ..storage import StorageManager
+
+VIDEO_DIR = "output/video"
+# the stages the raw captured files are left in, the later ones can be resumed as is
+UNJOINED_STATUSES = ("recording", "queued", "joining")
+JOINED_STATUSES = ("remuxing", "transcoding", "thumbnailing", "publishing")
+PARTIAL_FILE_PATTERN = re.compile(r"^([0-9a-f]{32})(\.part\d+\.mp4)?$")  # part files and segment directories
+
+
+def to_entry(record: Recording) -> RecordEntry:
+    return RecordEntry(
+        record_id=record.record_id,
+        camera_number=record.camera_number,
+        filename=record.filename,
+        status=record.status if record.status != "pending" else "recording",
+        start_time=record.start_time,
+        end_time=record.end_time,
+        thumbnail=record.thumbnail,
+        ipfs_cid=record.ipfs_cid,
+        ipfs_link=record.ipfs_link,
+    )
+
+
+def _from_entry(entry: RecordEntry) -> Recording:
+    record = Recording(rtsp_steam="", camera_number=entry.camera_number, record_id=entry.record_id)
+    record.filename = entry.filename or record.filename
+    record.status = entry.status
+    record.start_time = entry.start_time
+    record.end_time = entry.end_time
+    record.thumbnail = entry.thumbnail
+    record.ipfs_cid = entry.ipfs_cid
+    record.ipfs_link = entry.ipfs_link
+    return record
+
+
+async def save_record(record: Recording) -> None:
+    """persist the recording state, a database outage must not affect the recording itself"""
+    try:
+        await MongoDbWrapper().upsert_record(to_entry(record))
+    except Exception as e:
+        logger.error(f"Failed to save recording {record.record_id}: {e}")
+
+
+async def get_record(record_id: str) -> tp.Optional[Recording]:
+    """get an ongoing recording from memory or an ended one from the database"""
+    if record_id in records:
+        return records[record_id]
+
+    try:
+        return _from_entry(await MongoDbWrapper().get_record(record_id))
+    except ValueError:
+        return None
+
+
+def _to_local_time(time: datetime) -> datetime:
+    """convert the time to the naive local time the records are stored in"""
+    return time.astimezone().replace(tzinfo=None) if time.tzinfo else time
+
+
+def encode_cursor(entry: RecordEntry) -> str:
+    assert entry.start_time is not None
+    return urlsafe_b64encode(f"{entry.start_time.isoformat()}|{entry.record_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tp.Tuple[datetime, str]:
+    try:
+        start_time, record_id = urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(start_time), record_id
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+async def find_records(
+    status: tp.Optional[str] = None,
+    camera_number: tp.Optional[int] = None,
+    start_from: tp.Optional[datetime] = None,
+    start_to: tp.Optional[datetime] = None,
+    changed_since: tp.Optional[datetime] = None,
+    cursor: tp.Optional[str] = None,
+    limit: int = 100,
+) -> tp.Tuple[tp.List[RecordEntry], tp.Optional[str]]:
+    """get a page of the records matching the filters, latest first, and the cursor of the next page if any"""
+    query: tp.Dict[str, tp.Any] = {}
+
+    if status is not None:
+        query["status"] = status
+
+    if camera_number is not None:
+        query["camera_number"] = camera_number
+
+    if start_from is not None or start_to is not None:
+        query["start_time"] = {}
+
+        if start_from is not None:
+            query["start_time"]["$gte"] = _to_local_time(start_from)
+
+        if start_to is not None:
+            query["start_time"]["$lt"] = _to_local_time(start_to)
+
+    if changed_since is not None:
+        query["updated_at"] = {"$gt": _to_local_time(changed_since)}
+
+    before = decode_cursor(cursor) if cursor is not None else None
+    entries = await MongoDbWrapper().find_records(query, before, limit + 1)
+    next_cursor = encode_cursor(entries[limit - 1]) if len(entries) > limit else None
+    return entries[:limit], next_cursor
+
+
+async def get_last_update() -> tp.Optional[datetime]:
+    """get the time the records were last changed at"""
+    return await MongoDbWrapper().get_last_record_update()
+
+
+def is_changed_since(last_update: tp.Optional[datetime], since: datetime) -> bool:
+    return last_update is not None and last_update > _to_local_time(since)
+
+
+async def start_record(record: Recording, max_duration: float) -> None:
+    """start the recording, add it to the working set and have it stopped once it lasts max_duration seconds"""
+    await StorageManager().check_free_space()
+    await record.start()
+    records[record.record_id] = record
+    stuck_records.schedule(record.record_id, max_duration)
+    await save_record(record)
+
+
+async def stop_record(record: Recording) -> None:
+    """stop the recording and move it from the working set to the database"""
+    if records.pop(record.record_id, None) is None:
+        raise ValueError(f"Recording {record.record_id} is not ongoing or is already being stopped")
+
+    stuck_records.cancel(record.record_id)
+
+    try:
+        await record.stop(finish=not config.video.post_processing)
+    except Exception:
+        record.status = "failed"
+        record.end_time = record.end_time or datetime.now()
+        await save_record(record)
+        raise
+
+    if config.video.post_processing:
+        post_processor.submit(record)
+    else:
+        await save_record(record)
+
+
+async def _stop_stuck_record(record_id: str) -> None:
+    """stop a recording which reached its maximum duration, it is considered stuck or forgotten"""
+    record = records.get(record_id)
+
+    if record is not None:
+        logger.warning(f"Recording {record_id} reached its maximum duration of {len(record)} s. Stopping it.")
+        await stop_record(record)
+
+
+stuck_records: DeadlineScheduler[str] = DeadlineScheduler("Stuck records", _stop_stuck_record)
+post_processor = PostProcessor(config.video.post_processing_workers, save_record)
+
+
+async def _find_interrupted_records() -> tp.Dict[str, Recording]:
+    """get the recordings left ongoing in the database and the ones that only left partial files behind"""
+    interrupted: tp.Dict[str, Recording] = {}
+
+    try:
+        for entry in await MongoDbWrapper().get_records_by_status(UNJOINED_STATUSES):
+            interrupted[entry.record_id] = _from_entry(entry)
+    except Exception as e:
+        logger.error(f"Failed to get the interrupted recordings from the database: {e}")
+
+    if os.path.isdir(VIDEO_DIR):
+        for name in os.listdir(VIDEO_DIR):
+            match = PARTIAL_FILE_PATTERN.match(name)
+            path = os.path.join(VIDEO_DIR, name)
+            is_partial = bool(match and (match.group(2) or not os.path.exists(f"{path}/playlist.m3u8")))
+
+            if match and is_partial and match.group(1) not in interrupted:
+                interrupted[match.group(1)] = Recording(rtsp_steam="", record_id=match.group(1))
+
+    return interrupted
+
+
+async def _stop_orphaned_processes(interrupted: tp.Iterable[Recording]) -> None:
+    """stop the ffmpeg processes a previous run left writing the interrupted recordings and the camera captures"""
+    markers = [record.record_id for record in interrupted] + [f"{ingest.directory}/" for ingest in ingests.values()]
+
+    for marker in markers:
+        for pid in find_ffmpeg_processes(marker):
+            logger.warning(f"Terminating orphaned ffmpeg process {pid}")
+            await terminate_process(pid)
+
+
+async def reconcile_records() -> tp.List[Recording]:
+    """
+    stop the ffmpeg processes orphaned by a previous run and get the recordings it left unfinished.
+    Only the processes writing the recordings and captures of this gateway are stopped
+    """
+    interrupted = list((await _find_interrupted_records()).values())
+    await _stop_orphaned_processes(interrupted)
+    return interrupted
+
+
+async def recover_records(interrupted: tp.List[Recording]) -> None:
+    """finish the videos of the interrupted recordings and resume the interrupted post-processing"""
+    for record in interrupted:
+        was_stopped = record.status in ("queued", "joining")  # recorded completely, only the joining was interrupted
+
+        try:
+            await record.recover()
+        except Exception as e:
+            logger.error(f"Failed to recover recording {record.record_id}: {e}")
+            record.status = "failed"
+            record.end_time = record.end_time or datetime.now()
+
+        record.start_time = record.start_time or record.end_time  # unknown if the recording was never saved
+
+        if was_stopped and record.status == "interrupted":
+            post_processor.submit(record, join=False)
+        else:
+            await save_record(record)
+
+    try:
+        for entry in await MongoDbWrapper().get_records_by_status(JOINED_STATUSES):
+            logger.info(f"Resuming post-processing of recording {entry.record_id}")
+            post_processor.submit(_from_entry(entry), join=False)
+    except Exception as e:
+        logger.error(f"Failed to get the recordings being processed from the database: {e}")
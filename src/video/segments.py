@@ -0,0 +1,53 @@
+import csv
+import math
+import os
+import typing as tp
+
+Segment = tp.Tuple[str, float]  # segment file path and its duration in seconds
+
+
+def read_segment_list(list_file: str, default_duration: float) -> tp.List[Segment]:
+    """
+    Get the segments of a csv segment list written by the ffmpeg segment muxer.
+
+    Segments present on the disk but missing from the list (the one being written when ffmpeg
+    crashed) are appended with the default duration.
+    """
+    directory = os.path.dirname(list_file)
+    segments: tp.List[Segment] = []
+
+    if os.path.exists(list_file):
+        with open(list_file, newline="") as f:
+            for row in csv.reader(f):
+                if len(row) >= 3:
+                    segments.append((os.path.join(directory, row[0]), float(row[2]) - float(row[1])))
+
+    prefix = os.path.splitext(os.path.basename(list_file))[0] + "_"
+    listed = {path for path, _ in segments}
+    unlisted = sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith(prefix) and name.endswith(".ts")
+    )
+    segments.extend((path, default_duration) for path in unlisted if path not in listed and os.path.getsize(path) > 0)
+    return segments
+
+
+def write_playlist(playlist: str, runs: tp.List[tp.List[Segment]]) -> None:
+    """write an HLS VOD playlist of the segments, marking discontinuities between separate ffmpeg runs"""
+    durations = [duration for segments in runs for _, duration in segments]
+    target_duration = math.ceil(max(durations, default=1))
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{target_duration}", "#EXT-X-PLAYLIST-TYPE:VOD"]
+    directory = os.path.dirname(playlist)
+
+    for i, segments in enumerate(runs):
+        if i and segments:
+            lines.append("#EXT-X-DISCONTINUITY")
+
+        for path, duration in segments:
+            lines.extend((f"#EXTINF:{duration:.3f},", os.path.relpath(path, directory)))
+
+    lines.append("#EXT-X-ENDLIST")
+
+    with open(playlist, "w") as f:
+        f.write("\n".join(lines) + "\n")
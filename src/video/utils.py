@@ -1,21 +1,95 @@
+from __future__ import annotations
+
 import asyncio
+import heapq
+import itertools
+import typing as tp
+from time import monotonic
 
 from loguru import logger
 
-from .camera import records
+K = tp.TypeVar("K")
+
+
+class DeadlineScheduler(tp.Generic[K]):
+    """
+    Calls back exactly when the deadlines of the scheduled keys are reached.
+
+    The deadlines are kept in a heap and a single task sleeps until the earliest one, so any number
+    of them costs no polling. Cancelled and rescheduled deadlines are dropped from the heap lazily.
+    Callbacks run as separate tasks, so a slow one does not delay the others.
+    """
+
+    def __init__(self, name: str, callback: tp.Callable[[K], tp.Awaitable[None]]) -> None:
+        self.name = name
+        self._callback = callback
+        self._heap: tp.List[tp.Tuple[float, int, K]] = []
+        self._deadlines: tp.Dict[K, float] = {}
+        self._counter = itertools.count()  # breaks ties, so that the keys are never compared
+        self._wakeup: tp.Optional[asyncio.Event] = None
+        self._callbacks: tp.Set[asyncio.Task[None]] = set()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    @property
+    def wakeup(self) -> asyncio.Event:
+        """created lazily to be bound to the running loop"""
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+
+        return self._wakeup
+
+    def schedule(self, key: K, delay: float) -> None:
+        """call back with the key in delay seconds, replacing its previous deadline if any"""
+        deadline = monotonic() + delay
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+
+        if self._heap[0][0] == deadline:
+            self.wakeup.set()
+
+    def cancel(self, key: K) -> None:
+        """drop the deadline of the key if any"""
+        self._deadlines.pop(key, None)
+
+        if len(self._heap) > 2 * len(self._deadlines) + 64:  # too many stale entries, rebuild the heap
+            self._heap = [entry for entry in self._heap if self._deadlines.get(entry[2]) == entry[0]]
+            heapq.heapify(self._heap)
+
+    async def _call(self, key: K) -> None:
+        try:
+            await self._callback(key)
+        except Exception as e:
+            logger.error(f"{self.name}: callback for {key} failed: {e}")
+
+    def _fire_due(self) -> None:
+        now = monotonic()
+
+        while self._heap:
+            deadline, _, key = self._heap[0]
 
+            if self._deadlines.get(key) != deadline:  # cancelled or rescheduled
+                heapq.heappop(self._heap)
+            elif deadline <= now:
+                heapq.heappop(self._heap)
+                del self._deadlines[key]
+                task = asyncio.create_task(self._call(key))
+                self._callbacks.add(task)
+                task.add_done_callback(self._callbacks.discard)
+            else:
+                break
 
-async def end_stuck_records(max_duration: int = 60 * 60, interval: int = 60) -> None:
-    """If record length exceeds the maximum duration it is considered
-    stuck or forgotten and will be stopped. Checked every interval seconds."""
-    logger.info(
-        f"A daemon was started to monitor stuck records. Update interval is {interval} s., max allowed duration is {max_duration} s."
-    )
+    async def run(self) -> None:
+        """fire the callbacks as their deadlines come"""
+        logger.info(f"{self.name}: deadline scheduler started")
 
-    while True:
-        await asyncio.sleep(interval)
+        while True:
+            self._fire_due()
+            timeout = self._heap[0][0] - monotonic() if self._heap else None
+            self.wakeup.clear()
 
-        for rec_id, rec in records.items():
-            if rec.is_ongoing and len(rec) >= max_duration:
-                await records[rec_id].stop()
-                logger.warning(f"Recording {rec_id} exceeded {max_duration} s. and was stopped.")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -24,3 +24,33 @@ def test_print_image_annotated(test_img) -> None:
     )
     assert resp.ok
     assert resp.json().get("status") == 200
+
+
+@pytest.mark.printer
+def test_print_job_status(test_img) -> None:
+    resp = test_client.post("/printing/print_image", files={"image_file": open(test_img, "rb")})
+    job_id = resp.json().get("job_id")
+    assert job_id, resp.json()
+
+    job_resp = test_client.get(f"/printing/jobs/{job_id}")
+    assert job_resp.json().get("status") == 200
+    assert job_resp.json().get("job_status") in ("queued", "printing", "done")
+
+
+@pytest.mark.printer
+def test_get_printers() -> None:
+    resp = test_client.get("/printing/printers")
+    assert resp.json().get("status") == 200
+    assert resp.json().get("printers"), "No printers found (check config)"
+
+
+@pytest.mark.printer
+def test_print_batch(test_img) -> None:
+    resp = test_client.post(
+        "/printing/print_batch",
+        files=[("image_files", open(test_img, "rb"))],
+        data={"annotations": ["label 1", "label 2", "label 3"]},
+    )
+    assert resp.ok
+    assert resp.json().get("status") == 200
+    assert resp.json().get("job_id")
@@ -1,6 +1,8 @@
 from .. import test_client
 import os
 
+from src.io_gateway.cid import CHUNK_SIZE, MAX_LINKS, CidBuilder
+
 test_filename = "ipfs_test.txt"
 
 
@@ -25,3 +27,57 @@ def test_ipfs_push_valid_path() -> None:
     os.remove(test_filename)
     assert resp.ok
     assert resp.status_code == 200, f"File wasn't sent: {resp.json()}"
+
+
+def test_pin_status_unknown_cid() -> None:
+    resp = test_client.get("/io-gateway/pins/QmUnknownCid")
+    assert resp.ok
+    assert resp.json().get("status") == 404, "Got a pin status for a CID which was never published"
+
+
+def test_ipfs_push_same_file_twice() -> None:
+    with open(test_filename, "w") as f:
+        f.write("test file published twice")
+    req_data = {"absolute_path": os.path.abspath(test_filename)}
+    first_resp = test_client.post("/io-gateway/publish-to-ipfs/by-path", json=req_data)
+    second_resp = test_client.post("/io-gateway/publish-to-ipfs/by-path", json=req_data)
+    os.remove(test_filename)
+    assert first_resp.json().get("status") == 200, f"File wasn't sent: {first_resp.json()}"
+    assert first_resp.json().get("ipfs_cid") == second_resp.json().get("ipfs_cid"), "Same file got different CIDs"
+
+
+def test_ipfs_push_batch() -> None:
+    with open(test_filename, "w") as f:
+        f.write("test file published in a batch")
+    req_data = {"absolute_paths": [os.path.abspath(test_filename), os.path.abspath("wrong_file.name")]}
+    resp = test_client.post("/io-gateway/publish-to-ipfs/batch", json=req_data)
+    os.remove(test_filename)
+    assert resp.ok
+    valid_result, invalid_result = resp.json().get("results")
+    assert valid_result.get("ipfs_cid"), f"File wasn't sent: {valid_result}"
+    assert invalid_result.get("error"), "Gateway accepted invalid path"
+
+
+def _get_cid(data: bytes, piece_size: int = 100_000) -> str:
+    builder = CidBuilder()
+    for start in range(0, len(data), piece_size):
+        builder.update(data[start : start + piece_size])
+    return builder.cid()
+
+
+def test_cid_single_chunk() -> None:
+    assert _get_cid(b"") == "QmbFMke1KXqnYyBBWxB74N4c5SBnJMVAiMNRcGu6x1AwQH"
+    assert _get_cid(b"hello world\n") == "QmT78zSuBmuS4z925WZfrqQ1qHaJ56DQaTfyMUF7F8ff5o"
+
+
+def test_cid_multiple_chunks() -> None:
+    assert _get_cid(b"a" * (CHUNK_SIZE + 1)) == "QmTaxvXcxpzzaatSEEAYr7t3knkJ6DmTVbr8MjJJWLRWpV"
+    assert _get_cid(bytes(1024 * 1024)) == "QmVkbauSDEaMP4Tkq6Epm9uW75mWm136n81YH8fGtfwdHU"
+
+
+def test_cid_two_level_dag() -> None:
+    size = MAX_LINKS * CHUNK_SIZE + 1
+    data = (bytes(range(251)) * (size // 251 + 1))[:size]
+    assert (
+        _get_cid(data) == "QmTedsTekQQkgACJXb1sPZSW8bLdS9LPMrT7L4YdjNRd4n"
+    ), "CID of a DAG deeper than one level is off"